@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# This file is part of Sosuch CLI Tools.
+#
+# Sosuch CLI Tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sosuch CLI Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sosuch CLI Tools.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Local stand-in for the makaba engine serving recorded responses, and a
+# load driver running sosuch against it.
+#
+# Recordings use the layout of the sosuch mirror, so a board recorded with
+# `sosuch b sync` can be served with
+#   makaba_standin.py serve --data ~/.sosuch/mirror
+# and used with `sosuch -u http://127.0.0.1:8020 b ...`.
+#
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import random
+import threading
+import subprocess
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import loads, dumps
+from tempfile import mkdtemp
+from urllib.parse import urlsplit, parse_qs
+
+SOSUCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sosuch.py')
+DEFAULT_PORT = 8020
+CHUNK_INTERVAL = 0.1
+RE_TAG = re.compile(r'<[^>]*>')
+RE_REPLY = re.compile(r'&gt;&gt;(\d+)')
+
+# 1x1 transparent PNG served as captcha when the recording has none
+CAPTCHA_PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00'
+               b'\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\r'
+               b'IDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00'
+               b'\x00\x00\x00IEND\xaeB`\x82')
+
+
+class Recording(object):
+    """
+    Boards served by the stand-in. Threads are read from disk on first use
+    and kept in memory once posted to.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.changed = {}
+        self.last_num = 0
+
+    def boards(self):
+        return sorted(b for b in os.listdir(self.data_dir)
+                      if os.path.exists(os.path.join(self.data_dir, b, 'catalog.json')))
+
+    def thread_nums(self, board):
+        catalog = loads(self.read(board, 'catalog.json')[0].decode('utf-8'))
+        return [t['num'] for t in catalog['threads']]
+
+    def read(self, board, path):
+        """
+        :returns: (body, modification time) or None
+        :rtype: tuple
+        """
+        with self.lock:
+            if (board, path) in self.changed:
+                data, mtime = self.changed[(board, path)]
+                return dumps(data, ensure_ascii=False).encode('utf-8'), mtime
+        fn = os.path.join(self.data_dir, board, path)
+        if path == 'threads.json' and not os.path.exists(fn):
+            return self.thread_index(board)
+        if not os.path.exists(fn) and path.startswith('res/'):
+            fn = os.path.join(self.data_dir, board, 'archive', path[4:])
+        if not os.path.exists(fn):
+            return None
+        with open(fn, 'rb') as f:
+            return f.read(), os.path.getmtime(fn)
+
+    def thread_index(self, board):
+        """
+        threads.json built from the catalog when it was not recorded
+        """
+        found = self.read(board, 'catalog.json')
+        if found is None:
+            return None
+        catalog = loads(found[0].decode('utf-8'))
+        threads = [{'num': str(t['num']),
+                    'subject': RE_TAG.sub('', t.get('subject') or ''),
+                    'posts_count': t.get('posts_count', 0),
+                    'files_count': t.get('files_count', 0),
+                    'lasthit': t.get('lasthit', 0),
+                    'timestamp': t.get('timestamp', 0),
+                    'views': 0,
+                    'score': 0.0} for t in catalog['threads']]
+        return dumps({'board': board, 'threads': threads}, ensure_ascii=False).encode('utf-8'), found[1]
+
+    def add_post(self, board, thread, comment, subject='', name='', email=''):
+        """
+        :returns: Number of the new post, None for unknown threads
+        :rtype: int
+        """
+        path = 'res/%s.json' % thread
+        with self.lock:
+            if (board, path) not in self.changed:
+                fn = os.path.join(self.data_dir, board, path)
+                if not os.path.exists(fn):
+                    return None
+                with open(fn, 'rb') as f:
+                    self.changed[(board, path)] = (loads(f.read().decode('utf-8')), 0)
+            data = self.changed[(board, path)][0]
+            posts = data['threads'][0]['posts']
+            self.last_num = max(self.last_num, posts[-1]['num']) + 1
+            now = time.time()
+            posts.append({'num': self.last_num, 'parent': posts[0]['num'],
+                          'timestamp': int(now),
+                          'date': time.strftime('%d/%m/%y %H:%M:%S', time.localtime(now)),
+                          'name': name or 'Аноним', 'email': email or '',
+                          'subject': subject or '', 'comment': comment,
+                          'banned': 0, 'sticky': 0, 'closed': 0, 'op': 0,
+                          'files': []})
+            self.changed[(board, path)] = (data, now)
+            return self.last_num
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def add(self, kind, status, size, seconds):
+        with self.lock:
+            r = self.requests.setdefault(kind, {'count': 0, 'bytes': 0, 'status': {}, 'latency': []})
+            r['count'] += 1
+            r['bytes'] += size
+            r['status'][status] = r['status'].get(status, 0) + 1
+            r['latency'].append(seconds)
+
+    def report(self, out=sys.stdout):
+        with self.lock:
+            for kind in sorted(self.requests):
+                r = self.requests[kind]
+                lat = sorted(r['latency'])
+                pct = lambda q: lat[min(int(q * len(lat)), len(lat) - 1)] * 1000
+                print('%-8s %6d req %10d bytes  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  %s' %
+                      (kind, r['count'], r['bytes'], pct(0.5), pct(0.95), pct(0.99),
+                       ' '.join('%s:%d' % s for s in sorted(r['status'].items()))), file=out)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server_version = 'makaba-standin'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        started = time.time()
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/', 1)
+        if url.path == '/makaba/captcha.fcgi':
+            kind = 'captcha'
+        elif url.path == '/makaba/posting.fcgi':
+            kind = 'posting'
+        elif len(parts) == 2 and parts[1].endswith('.json'):
+            kind = {'catalog.json': 'catalog', 'threads.json': 'index'}.get(parts[1], 'thread')
+        else:
+            kind = 'other'
+        headers = {}
+        if random.random() < self.server.error_rate:
+            status, body = self.server.error_status, b'{"Error":-1,"Reason":"injected"}'
+        elif kind == 'captcha':
+            status, body = self.captcha(query)
+        elif kind == 'posting':
+            status, body = self.posting(query)
+        elif kind == 'other':
+            status, body = 404, b''
+        else:
+            status, body, headers = self.board_json(parts[0], parts[1])
+        if self.server.latency:
+            time.sleep(max(0, random.gauss(self.server.latency, self.server.jitter)))
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.send_body(body)
+        self.server.stats.add(kind, status, len(body), time.time() - started)
+
+    def send_body(self, body):
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+        chunk = max(1, int(self.server.bandwidth * CHUNK_INTERVAL))
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            self.wfile.flush()
+            time.sleep(CHUNK_INTERVAL)
+
+    def board_json(self, board, path):
+        found = self.server.recording.read(board, path)
+        if found is None:
+            return 404, b'', {}
+        body, mtime = found
+        headers = {'Content-Type': 'application/json',
+                   'Last-Modified': formatdate(int(mtime), usegmt=True),
+                   'ETag': '"%x"' % hash(body)}
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            return 304, b'', headers
+        since = self.headers.get('If-Modified-Since')
+        if since and 'If-None-Match' not in self.headers:
+            try:
+                if int(mtime) <= parsedate_to_datetime(since).timestamp():
+                    return 304, b'', headers
+            except (TypeError, ValueError):
+                pass
+        return 200, body, headers
+
+    def captcha(self, query):
+        if query.get('action') == 'thread':
+            return 200, ('CHECK\n%x' % random.getrandbits(64)).encode('utf-8')
+        if query.get('action') == 'image':
+            fn = os.path.join(self.server.recording.data_dir, 'captcha.png')
+            if os.path.exists(fn):
+                with open(fn, 'rb') as f:
+                    return 200, f.read()
+            return 200, CAPTCHA_PNG
+        return 404, b''
+
+    def posting(self, query):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        msg = BytesParser().parsebytes(('Content-Type: %s\r\n\r\n' % self.headers.get('Content-Type', '')).encode('utf-8') + body)
+        fields = {}
+        if msg.is_multipart():
+            for part in msg.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename() is None:
+                    fields[name] = part.get_payload(decode=True).decode('utf-8', 'replace')
+        num = self.server.recording.add_post(query.get('board'), query.get('thread'),
+                                             markup(query.get('board'), query.get('thread'), fields.get('comment', '')),
+                                             fields.get('subject'), fields.get('name'), fields.get('email'))
+        if num is None:
+            return 200, dumps({'Error': -2, 'Reason': 'Тред не существует.'}).encode('utf-8')
+        return 200, dumps({'Status': 'OK', 'Num': num}).encode('utf-8')
+
+
+def markup(board, thread, comment):
+    """
+    Comment HTML the way makaba renders it: escaped text, <br> line breaks
+    and reply links (all pointing into the same thread)
+    """
+    comment = escape(comment, quote=False).replace('\r\n', '\n').replace('\n', '<br>')
+    return RE_REPLY.sub(lambda m: '<a href="/%s/res/%s.html#%s" class="post-reply-link" data-thread="%s" data-num="%s">&gt;&gt;%s</a>' %
+                        (board, thread, m.group(1), thread, m.group(1), m.group(1)), comment)
+
+
+def make_server(args):
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StandinHandler)
+    server.daemon_threads = True
+    server.recording = Recording(args.data)
+    server.stats = Stats()
+    server.latency = args.latency
+    server.jitter = args.jitter
+    server.bandwidth = args.bandwidth
+    server.error_rate = args.error_rate
+    server.error_status = args.error_status
+    server.verbose = args.verbose
+    return server
+
+
+def inject_posts(recording, rate, stop):
+    """
+    Adds a post to a random recorded thread rate times per second
+    """
+    targets = [(b, n) for b in recording.boards() for n in recording.thread_nums(b)]
+    injected = 0
+    while targets and not stop.wait(1.0 / rate):
+        board, thread = random.choice(targets)
+        if recording.add_post(board, thread, 'injected post %d' % injected) is not None:
+            injected += 1
+    return injected
+
+
+def run_client(command, env):
+    """
+    :returns: (exit status, output lines)
+    :rtype: tuple
+    """
+    p = subprocess.Popen([sys.executable, SOSUCH] + command, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    lines = p.stdout.read().count(b'\n')
+    return p.wait(), lines
+
+
+def run_clients(commands, env, clients):
+    """
+    Runs sosuch commands, at most clients of them at once
+
+    :returns: (wall time, number of failed commands, output lines)
+    :rtype: tuple
+    """
+    started = time.time()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(lambda c: run_client(c, env), commands))
+    return (time.time() - started, sum(1 for status, _ in results if status != 0),
+            sum(lines for _, lines in results))
+
+
+def load(args, server):
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    boards = server.recording.boards()
+    env = dict(os.environ, SOSUCH_MIRROR=mkdtemp(prefix='sosuch-load'))
+    base = ['-u', url, '-f', 'jsonl']
+    if args.scenario == 'threads':
+        commands = [base + [b] for b in boards] * args.clients
+    elif args.scenario == 'lite':
+        commands = [base + ['--lite', b] for b in boards] * args.clients
+    elif args.scenario == 'posts':
+        commands = [base + [b, 'thread', str(n)] for b in boards for n in server.recording.thread_nums(b)]
+    elif args.scenario == 'sync':
+        commands = [base + [b, 'sync'] for b in boards]
+    else:
+        specs = ['%s/%s' % (b, n) for b in boards for n in server.recording.thread_nums(b)]
+        commands = [base + [boards[0], 'watch', '--min-interval', str(args.min_interval)] + specs]
+    stop = threading.Event()
+    injected = []
+    if args.scenario == 'watch':
+        injector = threading.Thread(target=lambda: injected.append(inject_posts(server.recording, args.post_rate, stop)))
+        injector.start()
+        timer = threading.Timer(args.duration, stop.set)
+        timer.start()
+        started = time.time()
+        p = subprocess.Popen([sys.executable, SOSUCH] + commands[0], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        stop.wait()
+        p.terminate()
+        lines = p.stdout.read().count(b'\n')
+        p.wait()
+        injector.join()
+        print('watch: %d threads for %.1fs, %d posts injected, %d printed' %
+              (len(specs), time.time() - started, injected[0], lines))
+    else:
+        wall, failed, lines = run_clients(commands, env, args.clients)
+        print('%s: %d commands on %d boards in %.2fs, %d failed, %d output lines' %
+              (args.scenario, len(commands), len(boards), wall, failed, lines))
+    server.stats.report()
+
+
+def main():
+    parser = ArgumentParser(add_help=True, description='Local makaba stand-in and load driver for sosuch')
+    parser.add_argument('action', choices=['serve', 'load'], help='serve recorded boards or run a load scenario against them')
+    parser.add_argument('-d', '--data', action='store', required=True, help='recording directory (same layout as the sosuch mirror)')
+    parser.add_argument('-p', '--port', action='store', type=int, default=None, help='listen port, %d for serve and any free one for load' % DEFAULT_PORT)
+    parser.add_argument('-l', '--latency', action='store', type=float, default=0, help='mean response latency in seconds')
+    parser.add_argument('-j', '--jitter', action='store', type=float, default=0, help='standard deviation of latency in seconds')
+    parser.add_argument('-b', '--bandwidth', action='store', type=int, default=0, help='bytes per second per response, 0 for unlimited')
+    parser.add_argument('-e', '--error-rate', action='store', type=float, default=0, help='fraction of requests failing')
+    parser.add_argument('--error-status', action='store', type=int, default=503, help='HTTP status of injected errors')
+    parser.add_argument('-r', '--post-rate', action='store', type=float, default=0, help='new posts per second added to random threads')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    parser.add_argument('-s', '--scenario', choices=['threads', 'lite', 'posts', 'sync', 'watch'], default='threads', help='load scenario')
+    parser.add_argument('-c', '--clients', action='store', type=int, default=4, help='concurrent sosuch processes, threads and lite scenarios list every board this many times')
+    parser.add_argument('-t', '--duration', action='store', type=float, default=30, help='watch scenario duration in seconds')
+    parser.add_argument('--min-interval', action='store', type=float, default=1, help='watch scenario minimal poll interval')
+    args = parser.parse_args()
+
+    if args.port is None:
+        args.port = DEFAULT_PORT if args.action == 'serve' else 0
+    if args.action == 'load' and args.scenario == 'watch' and not args.post_rate:
+        args.post_rate = 1
+    server = make_server(args)
+    stop = threading.Event()
+    if args.action == 'serve':
+        if args.post_rate:
+            threading.Thread(target=inject_posts, args=(server.recording, args.post_rate, stop), daemon=True).start()
+        print('Serving %s on http://127.0.0.1:%d' % (', '.join(server.recording.boards()), server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            stop.set()
+            server.stats.report()
+    else:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            load(args, server)
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,33 +19,218 @@
 #
 from __future__ import print_function
 
+import os
+import sys
+import shutil
+import socket
+import struct
+from json import loads, dumps
+from subprocess import check_output, call, Popen, PIPE, TimeoutExpired
+
+DAEMON_SOCKET = os.environ.get('SOSUCH_SOCKET', os.path.expanduser('~/.sosuch/daemon.sock'))
+DAEMON_ENV = ['SOSUCH_URL', 'SOSUCH_MIRRORS', 'SOSUCH_MIRROR', 'SOSUCH_SOLVER']
+# interactive commands and daemon control always run in-process
+DAEMON_LOCAL_ACTIONS = ['watch']
+DAEMON_LOCAL_THREAD_ACTIONS = ['read', 'editor', 'post', 'file']
+DAEMON_LOCAL_OPTIONS = ['--follow', '--daemon', '--completion', '--metrics', '--no-daemon']
+# options before the board command which take a value
+DAEMON_VALUE_OPTIONS = ['-u', '--url', '-M', '--mirror', '-f', '--format', '--width', '-r', '--rate',
+                        '--metrics', '--solver', '--solvers']
+# seconds to wait for a busy daemon before running the command in-process
+DAEMON_WAIT = 0.5
+
+def send_frame(sock, kind, data):
+    sock.sendall(struct.pack('!cI', kind, len(data)) + data)
+
+def recv_frame(f):
+    head = f.read(5)
+    if len(head) < 5:
+        return None, None
+    kind, n = struct.unpack('!cI', head)
+    return kind, f.read(n)
+
+def command_words(argv):
+    """
+    :returns: Positional words of the command line: board, board command,
+    thread and thread command
+    :rtype: list
+    """
+    words = []
+    args = iter(argv)
+    for a in args:
+        if a == '--':
+            words.extend(args)
+        elif a in DAEMON_VALUE_OPTIONS:
+            next(args, None)
+        elif not a.startswith('-') or a == '-':
+            words.append(a)
+    return words[:4]
+
+def run_local(argv):
+    """
+    :returns: Whether the command is interactive or controls the daemon
+    and has to run in-process
+    :rtype: bool
+    """
+    words = command_words(argv) + [None] * 4
+    options = argv[:argv.index('--')] if '--' in argv else argv
+    return (any(a in DAEMON_LOCAL_OPTIONS for a in options) or words[1] in DAEMON_LOCAL_ACTIONS or
+            (words[1] == 'thread' and words[3] in DAEMON_LOCAL_THREAD_ACTIONS))
+
+def forward(argv):
+    """
+    Runs the command in the daemon listening on DAEMON_SOCKET (see serve)
+    and copies its output to stdout and stderr, starting the pager when
+    the daemon asks for it. A daemon which does not start the command
+    within DAEMON_WAIT (busy with another one) is left alone.
+
+    :returns: Exit code, None when the command has to run in-process
+    :rtype: int
+    """
+    if run_local(argv) or not os.path.exists(DAEMON_SOCKET):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(DAEMON_WAIT)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        return None
+    request = {'argv': argv,
+               'cwd': os.getcwd(),
+               'tty': sys.stdout.isatty(),
+               'columns': shutil.get_terminal_size().columns,
+               'pager': os.environ.get('PAGER', 'less'),
+               'env': dict((k, os.environ.get(k)) for k in DAEMON_ENV)}
+    out = sys.stdout.buffer
+    pager = None
+    started = False
+    try:
+        sock.sendall(dumps(request).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+        kind, _ = recv_frame(f)
+        if kind != b's':
+            return None
+        # the daemon runs the command only after this
+        sock.sendall(b'g')
+        sock.settimeout(None)
+        while True:
+            kind, data = recv_frame(f)
+            if kind is None or kind == b'r':
+                if started:
+                    print("Daemon closed connection", file=sys.stderr)
+                    return 1
+                return None
+            started = True
+            if kind == b'o':
+                out.write(data)
+                out.flush()
+            elif kind == b'e':
+                sys.stderr.buffer.write(data)
+                sys.stderr.buffer.flush()
+            elif kind == b'p':
+                env = dict(os.environ)
+                env.setdefault('LESS', 'FRX')
+                pager = Popen(data.decode('utf-8'), shell=True, stdin=PIPE, env=env)
+                out = pager.stdin
+            elif kind == b'x':
+                return int(data)
+    except BrokenPipeError:
+        if pager is None:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except KeyboardInterrupt:
+        if pager is None:
+            return 130
+        return 0
+    except OSError as e:
+        if started:
+            print("Daemon connection failed: %s" % e, file=sys.stderr)
+            return 1
+        return None
+    finally:
+        sock.close()
+        if pager is not None:
+            try:
+                pager.stdin.close()
+            except BrokenPipeError:
+                pass
+            pager.wait()
+
+if __name__ == '__main__':
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
 import certifi
-from urllib3 import PoolManager
+from urllib3 import PoolManager, Timeout, Retry
+from urllib3.exceptions import HTTPError
 from urllib.parse import urlencode
-from json import loads
 from colorama import init, Fore, Back, Style
-from subprocess import check_output, call
-import sys
-import os
 from argparse import ArgumentParser, FileType
 import re
 import cgi
 import yaml
+import time
+import threading
+import signal
+import atexit
+import select
+import fcntl
+import shlex
+import socketserver
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import get_context, get_all_start_methods
+from heapq import heappush, heappop, heapify
+from itertools import count, repeat, islice
+from gzip import GzipFile
+from io import TextIOWrapper, BytesIO
+from queue import Queue, Empty
 from tempfile import mkstemp
+from hashlib import md5
 try:
     import htmlentitydefs
     import urlparse
     import HTMLParser
+    html_unescape = HTMLParser.HTMLParser().unescape
+    from cgi import escape as html_escape
 except ImportError:  # Python3
     import html.entities as htmlentitydefs
     import urllib.parse as urlparse
     import html.parser as HTMLParser
+    from html import unescape as html_unescape, escape as html_escape
 try:  # Python3
     import urllib.request as urllib
 except ImportError:
     import urllib
-
-BASE_URL = 'https://2ch.hk'
+try:
+    import curses
+except ImportError:
+    curses = None
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    unichr
+except NameError:  # Python3
+    unichr = chr
+    unicode = str
+
+BASE_URL = os.environ.get('SOSUCH_URL', 'https://2ch.hk')
+MIRRORS = [m.rstrip('/') for m in os.environ.get('SOSUCH_MIRRORS', '').split(',') if m]
+HEDGE = False
 STYLE_NUM = Fore.CYAN
 STYLE_SUBJ = Fore.WHITE + Style.BRIGHT
 STYLE_NAME = Fore.BLUE + Style.DIM
@@ -58,7 +243,196 @@ STYLE_IMGS = Fore.MAGENTA
 STYLE_SUMMARY = Style.DIM + Fore.GREEN
 STYLE_RESET = Style.RESET_ALL
 CAPTCHA_RESOLVE_SCRIPT = '2chaptcha_resolve.py'
+CAPTCHA_SOLVER = os.environ.get('SOSUCH_SOLVER')
+CAPTCHA_SOLVERS = 1
+CAPTCHA_SOLVER_TIMEOUT = 60
+OUTPUT_FORMATS = ['text', 'plain', 'jsonl']
+RECORD_KEYS = ['num', 'parent', 'timestamp', 'date', 'name', 'email', 'subject',
+               'comment', 'banned', 'sticky', 'closed', 'posts_count',
+               'files_count', 'lasthit']
+RECORD_FILE_KEYS = ['path', 'name', 'md5', 'size']
 EDITOR = os.environ.get('EDITOR','vim')
+PAGER = os.environ.get('PAGER', 'less')
+WATCH_MIN_INTERVAL = 10
+WATCH_MAX_INTERVAL = 600
+WATCH_BACKOFF = 1.5
+WATCH_RATE_WINDOW = 5
+WATCH_WORKERS = 4
+MIRROR_DIR = os.environ.get('SOSUCH_MIRROR', os.path.expanduser('~/.sosuch/mirror'))
+OWN_INDEX = os.environ.get('SOSUCH_OWN', os.path.expanduser('~/.sosuch/own.json'))
+SNAPSHOT_DIR = os.environ.get('SOSUCH_SNAPSHOTS', os.path.expanduser('~/.sosuch/snapshots'))
+SYNC_WORKERS = 4
+READER_CACHE_SIZE = 128
+QUOTE_MAX_THREADS = 8
+QUOTE_WORKERS = 4
+QUOTE_PREVIEW_LEN = 160
+READER_POLL_MS = 500
+JSON_CACHE_SIZE = 64
+PRIORITY_INTERACTIVE = 0
+PRIORITY_WATCH = 1
+PRIORITY_BACKGROUND = 2
+RATE_LIMITS = {'*': (5.0, 10)}
+RATE_BACKOFF = 2
+RATE_BACKOFF_MAX = 120
+RATE_BACKOFF_STATUS = (429, 503)
+RATE_RETRIES = 3
+RATE_MAX_WAIT = 1
+MIRROR_SAMPLES = 50
+MIRROR_EWMA = 0.2
+MIRROR_DEFAULT_LATENCY = 0.5
+MIRROR_DOWN_TIME = 30
+MIRROR_CONNECT_TIMEOUT = 5
+# between received bytes, a stalled site is failed over after this
+MIRROR_READ_TIMEOUT = 15
+HEDGE_DEFAULT_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 10
+METRICS_INTERVAL = 15
+METRICS_BUCKETS = {
+    'sosuch_request_seconds': (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    'sosuch_html2text_seconds': (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1),
+}
+METRICS_HELP = {
+    'sosuch_requests_total': 'HTTP requests by endpoint and status',
+    'sosuch_request_seconds': 'HTTP request latency by endpoint, scheduler wait excluded',
+    'sosuch_response_bytes_total': 'HTTP response bytes by endpoint',
+    'sosuch_json_cache_total': 'board JSON cache lookups by result',
+    'sosuch_posts_rendered_total': 'posts rendered by output format',
+    'sosuch_html2text_seconds': 'time to convert a post to text',
+    'sosuch_scheduler_waiting': 'requests waiting for the scheduler by host',
+    'sosuch_scheduler_backoff_seconds': 'time left until a backed off host is used again',
+    'sosuch_watch_targets': 'threads and catalogs followed by watch',
+    'sosuch_failover_total': 'reads moved off a failing mirror',
+    'sosuch_hedged_total': 'hedged reads by the mirror which answered first',
+}
+COMPLETE_DIR = os.environ.get('SOSUCH_COMPLETE', os.path.expanduser('~/.sosuch/complete'))
+COMPLETE_SUBJECT_LEN = 40
+COMPLETE_MAX_AGE = 10
+COMPLETE_COMMON = r'''
+@FUNC@_index() {
+    local dir="${SOSUCH_COMPLETE:-$HOME/.sosuch/complete}"
+    if [ -z "$1" ]; then
+        [ -d "$dir" ] && command ls "$dir"
+        return
+    fi
+    # refresh indexes older than @MAX_AGE@ minutes without waiting for it
+    if [ -z "$(find "$dir/$1" -mmin -@MAX_AGE@ 2>/dev/null)" ]; then
+        (@PROG@ -l -f plain -P "$1" >/dev/null 2>&1 &)
+    fi
+    [ -f "$dir/$1" ] && command cat "$dir/$1"
+}
+
+@FUNC@_words() {
+    # positional words of the command line, option values skipped
+    local w skip=
+    for w in "$@"; do
+        if [ -n "$skip" ]; then
+            skip=
+            continue
+        fi
+        case "$w" in
+            -u|--url|-M|--mirror|-f|--format|--width|-r|--rate|--solver|--solvers|--metrics) skip=1 ;;
+            -*) ;;
+            *) printf '%s\n' "$w" ;;
+        esac
+    done
+}
+'''
+COMPLETE_SCRIPTS = {
+    'bash': COMPLETE_COMMON + r'''
+@FUNC@() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}"
+    case "$prev" in
+        -f|--format) COMPREPLY=($(compgen -W "text plain jsonl" -- "$cur")); return ;;
+        --solver) COMPREPLY=($(compgen -c -- "$cur")); return ;;
+        -u|--url|-M|--mirror|--width|-r|--rate|--solvers|--metrics) return ;;
+    esac
+    if [ "${cur#-}" != "$cur" ]; then
+        COMPREPLY=($(compgen -W "-u --url -M --mirror --hedge -f --format -t --text -w --wrap --width -Q --quotes -P --no-pager -l --lite -O --optimize-images --solver --solvers -D --drop-duplicates --offline -r --rate --metrics --no-daemon" -- "$cur"))
+        return
+    fi
+    local words=($(@FUNC@_words "${COMP_WORDS[@]:1:COMP_CWORD-1}"))
+    local board="${words[0]}"
+    case "${#words[@]}:${words[1]}" in
+        0:) COMPREPLY=($(compgen -W "$(@FUNC@_index)" -- "$cur")) ;;
+        1:*) COMPREPLY=($(compgen -W "thread watch replies sync grep archive diff stats export" -- "$cur")) ;;
+        2:thread|*:watch|*:diff) COMPREPLY=($(compgen -W "$(@FUNC@_index "$board" | cut -f1)" -- "$cur")) ;;
+        3:thread) COMPREPLY=($(compgen -W "post file editor read" -- "$cur")) ;;
+        4:thread) [ "${words[3]}" = file ] && COMPREPLY=($(compgen -f -- "$cur")) ;;
+        2:export|2:archive) COMPREPLY=($(compgen -f -- "$cur")) ;;
+    esac
+}
+complete -F @FUNC@ @PROG@
+''',
+    'zsh': COMPLETE_COMMON + r'''
+@FUNC@() {
+    local -a words_ threads
+    words_=("${(@f)$(@FUNC@_words "${(@)words[2,CURRENT-1]}")}")
+    words_=(${words_:#})
+    case "${words[CURRENT-1]}" in
+        -f|--format) compadd -- text plain jsonl; return ;;
+        --solver) _command_names; return ;;
+        -u|--url|-M|--mirror|--width|-r|--rate|--solvers|--metrics) return ;;
+    esac
+    if [[ "$PREFIX" == -* ]]; then
+        compadd -- -u --url -M --mirror --hedge -f --format -t --text -w --wrap --width -Q --quotes -P --no-pager -l --lite -O --optimize-images --solver --solvers -D --drop-duplicates --offline -r --rate --metrics --no-daemon
+        return
+    fi
+    case "${#words_}:${words_[2]}" in
+        0:) compadd -- ${(f)"$(@FUNC@_index)"} ;;
+        1:*) compadd -- thread watch replies sync grep archive diff stats export ;;
+        2:thread|*:watch|*:diff)
+            threads=(${(f)"$(@FUNC@_index "${words_[1]}" | sed 's/\t/:/; s/\\/\\\\/g')"})
+            _describe 'thread' threads ;;
+        3:thread) compadd -- post file editor read ;;
+        4:thread) [[ "${words_[4]}" == file ]] && _files ;;
+        2:export|2:archive) _files ;;
+    esac
+}
+compdef @FUNC@ @PROG@
+''',
+}
+DAEMON_FRAME_SIZE = 64 * 1024
+DAEMON_GLOBALS = ['BASE_URL', 'MIRRORS', 'HEDGE', 'CAPTCHA_SOLVER', 'CAPTCHA_SOLVERS', 'PAGER', 'BODY_WIDTH', 'WATCH_MIN_INTERVAL', 'WATCH_MAX_INTERVAL', 'RATE_LIMITS']
+STATS_COLUMNS = ['num', 'thread', 'timestamp', 'files', 'reply_src', 'reply_dst', 'reply_thread']
+STATS_PARSE_CHUNK = 64
+STATS_TOP = 10
+GREP_WORKERS = 4
+DIFF_WORKERS = 4
+SNAPSHOT_KEYS = ['subject', 'name', 'email', 'comment', 'banned']
+SNAPSHOT_DIGEST_SIZE = 16
+ARCHIVE_VERSION = 2
+ARCHIVE_FORMATS = {'html': 'html', 'markdown': 'md'}
+ARCHIVE_KEYS = ['num', 'subject', 'name', 'email', 'date', 'comment', 'banned', 'sticky', 'closed']
+ARCHIVE_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; max-width: 60em; margin: auto; background: #eee; }
+.post { background: #ddd; margin: 0.5em 0; padding: 0.3em 0.6em; }
+.post:target { background: #cdd; }
+.subject { font-weight: bold; }
+.name { color: #117743; }
+.flag { color: #a00; }
+.count { color: #777; }
+blockquote { margin: 0.5em 1em; }
+</style>
+</head>
+<body>
+<h1>%(title)s</h1>
+%(body)s</body>
+</html>
+"""
+GREP_CONTEXT = 40
+
+IMAGE_KEYS = ['image1', 'image2', 'image3', 'image4']
+IMAGE_MAX_SIZE = 20 * 1024 * 1024
+IMAGE_MAX_DIMENSION = 4096
+IMAGE_JPEG_QUALITY = 85
+IMAGE_WORKERS = os.cpu_count() or 2
+HASH_WORKERS = 4
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 POST_TEMPLATE = """---
 postready: no
@@ -72,7 +446,16 @@ image4:
 ...
 """
 
-http = PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+# keep a connection per worker of watch, sync, replies, grep and diff
+http = PoolManager(maxsize=max(WATCH_WORKERS, SYNC_WORKERS, QUOTE_WORKERS, GREP_WORKERS, DIFF_WORKERS),
+                   cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+json_cache = OrderedDict()
+json_cache_lock = threading.Lock()
+mirror_stats = {}
+mirror_lock = threading.Lock()
+solvers = None
+solvers_lock = threading.Lock()
+metrics = None
 
 # -----------------
 # --- HTML2Text ---
@@ -114,36 +497,36 @@ IGNORE_EMPHASIS = False
 # For checking space-only lines on line 771
 RE_SPACE = re.compile(r'\s\+')
 
+RE_WHITESPACE = re.compile(r'\s+')
+RE_TAG = re.compile(r'<[^>]*>')
+RE_SITE_HREF = re.compile(r'href="/(?!/)')
+RE_REPLY_TEXT = re.compile(r'>>(\d+)')
+RE_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+RE_REPLY_LINK = re.compile(r'&gt;&gt;(\d+)')
+RE_REPLY_HREF = re.compile(r'href="/(\w+)/res/(\d+)\.html#(\d+)"')
+RE_ABSOLUTE_URL = re.compile(r'^[a-zA-Z+]+://')
+
 RE_UNESCAPE = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
 RE_ORDERED_LIST_MATCHER = re.compile(r'\d+\.\s')
 RE_UNORDERED_LIST_MATCHER = re.compile(r'[-\*\+]\s')
 RE_MD_CHARS_MATCHER = re.compile(r"([\\\[\]\(\)])")
 RE_MD_CHARS_MATCHER_ALL = re.compile(r"([`\*_{}\[\]\(\)#!])")
-RE_MD_DOT_MATCHER = re.compile(r"""
-    ^             # start of line
-    (\s*\d+)      # optional whitespace and a number
-    (\.)          # dot
-    (?=\s)        # lookahead assert whitespace
-    """, re.MULTILINE | re.VERBOSE)
-RE_MD_PLUS_MATCHER = re.compile(r"""
-    ^
-    (\s*)
-    (\+)
-    (?=\s)
-    """, flags=re.MULTILINE | re.VERBOSE)
-RE_MD_DASH_MATCHER = re.compile(r"""
-    ^
-    (\s*)
-    (-)
-    (?=\s|\-)     # followed by whitespace (bullet list, or spaced out hr)
-                  # or another dash (header or hr)
-    """, flags=re.MULTILINE | re.VERBOSE)
 RE_SLASH_CHARS = r'\`*_{}[]()#+-.!'
-RE_MD_BACKSLASH_MATCHER = re.compile(r'''
-    (\\)          # match one slash
-    (?=[%s])      # followed by a char that requires escaping
+# Escapes everything markdown-sensitive at the start of lines and existing
+# slashes in a single pass, substitute with r"\1\\\2\3"
+RE_MD_SECTION_MATCHER = re.compile(r'''
+    ^                     # start of line
+    (\s*\d+(?=\.\s)       # optional whitespace and a number, followed by
+                          # a dot and whitespace
+    |\s*(?=\+\s|-[\s\-]))  # or optional whitespace followed by a plus and
+                          # whitespace, or by a dash and whitespace (bullet
+                          # list, or spaced out hr) or another dash (header
+                          # or hr)
+    ([.+-])               # the dot, plus or dash
+    |(\\)(?=[%s])        # or one slash followed by a char that requires
+                          # escaping
     ''' % re.escape(RE_SLASH_CHARS),
-    flags=re.VERBOSE)
+    flags=re.MULTILINE | re.VERBOSE)
 
 UNIFIABLE = {
     'rsquo': "'",
@@ -188,6 +571,20 @@ UNIFIABLE = {
 
 BYPASS_TABLES = False
 
+# Resolved element styles are shared by all parsers using the default
+# style definitions, see HTML2Text.resolve_style
+DEFAULT_STYLE_DEF = {'.post-reply-link': {'quote': 'quote'},
+                     '.unkfunc': {'quote': 'quote'},
+                     '.o': {},
+                     '.u': {},
+                     '.s': {},
+                     '.spoiler': {'spoiler': 'spoiler'}}
+STYLE_CACHE = {}
+STYLE_CACHE_SIZE = 4096
+ROOT_STYLE = (0, {}, [], False)
+NO_ATTRS = {}
+style_ids = count(1)
+
 # Use a single line break after a block element rather an two line breaks.
 # NOTE: Requires body width setting to be 0.
 SINGLE_LINE_BREAK = False
@@ -388,6 +785,49 @@ def skipwrap(para):
     return False
 
 
+def visible_len(s):
+    """
+    Length of the string on the terminal, ANSI escape sequences excluded
+
+    :rtype: int
+    """
+    if '\x1b' not in s:
+        return len(s)
+    return len(RE_ANSI.sub('', s))
+
+
+def wrap(text, width):
+    """
+    Greedy word wrap which does not count ANSI escape sequences towards
+    the width. Words longer than the width are left unbroken.
+
+    :type text: str
+    :type width: int
+
+    :rtype: list
+    """
+    lines = []
+    line = []
+    line_len = 0
+    for word in text.split():
+        word_len = visible_len(word)
+        if line and line_len + 1 + word_len > width:
+            lines.append(' '.join(line))
+            line = []
+        if line:
+            line_len += 1 + word_len
+        else:
+            line_len = word_len
+        line.append(word)
+    if line:
+        lines.append(' '.join(line))
+    return lines
+
+
+def terminal_width():
+    return shutil.get_terminal_size().columns
+
+
 def wrapwrite(text):
     text = text.encode('utf-8')
     try:  # Python3
@@ -418,15 +858,11 @@ def escape_md_section(text, snob=False):
     """
     Escapes markdown-sensitive characters across whole document sections.
     """
-    text = RE_MD_BACKSLASH_MATCHER.sub(r"\\\1", text)
+    text = RE_MD_SECTION_MATCHER.sub(r"\1\\\2\3", text)
 
     if snob:
         text = RE_MD_CHARS_MATCHER_ALL.sub(r"\\\1", text)
 
-    text = RE_MD_DOT_MATCHER.sub(r"\1\\\2", text)
-    text = RE_MD_PLUS_MATCHER.sub(r"\1\\\2", text)
-    text = RE_MD_DASH_MATCHER.sub(r"\1\\\2", text)
-
     return text
 
 class HTML2Text(HTMLParser.HTMLParser):
@@ -486,7 +922,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.astack = []
         self.maybe_automatic_link = None
         self.empty_link = False
-        self.absolute_url_matcher = re.compile(r'^[a-zA-Z+]+://')
+        self.absolute_url_matcher = RE_ABSOLUTE_URL
         self.acount = 0
         self.list = []
         self.blockquote = 0
@@ -497,12 +933,8 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.lastWasNL = 0
         self.lastWasList = False
         self.style = 0
-        self.style_def = {'.post-reply-link': {'quote': 'quote'},
-                          '.unkfunc': {'quote': 'quote'},
-                          '.o': {},
-                          '.u': {},
-                          '.s': {},
-                          '.spoiler': {'spoiler': 'spoiler'}}
+        self.style_def = DEFAULT_STYLE_DEF.copy()
+        self.style_cache = STYLE_CACHE
         self.tag_stack = []
         self.emphasis = 0
         self.drop_white_space = 0
@@ -512,10 +944,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.abbr_list = {}  # stack of abbreviations to write later
         self.baseurl = baseurl
 
-        try:
-            del unifiable_n[name2cp('nbsp')]
-        except KeyError:
-            pass
+        unifiable_n.pop(name2cp('nbsp'), None)
         UNIFIABLE['nbsp'] = '&nbsp_place_holder;'
 
     def feed(self, data):
@@ -535,29 +964,15 @@ class HTML2Text(HTMLParser.HTMLParser):
     def close(self):
         HTMLParser.HTMLParser.close(self)
 
-        try:
-            nochr = unicode('')
-        except NameError:
-            nochr = str('')
-
         self.pbr()
         self.o('', 0, 'end')
 
-        outtext = nochr.join(self.outtextlist)
+        outtext = unicode('').join(self.outtextlist)
         if self.unicode_snob:
-            try:
-                nbsp = unichr(name2cp('nbsp'))
-            except NameError:
-                nbsp = chr(name2cp('nbsp'))
+            nbsp = unichr(name2cp('nbsp'))
         else:
-            try:
-                nbsp = unichr(32)
-            except NameError:
-                nbsp = chr(32)
-        try:
-            outtext = outtext.replace(unicode('&nbsp_place_holder;'), nbsp)
-        except NameError:
-            outtext = outtext.replace('&nbsp_place_holder;', nbsp)
+            nbsp = unichr(32)
+        outtext = outtext.replace(unicode('&nbsp_place_holder;'), nbsp)
 
         # Clear self.outtextlist to avoid memory leak of its content to
         # the next handling.
@@ -610,22 +1025,57 @@ class HTML2Text(HTMLParser.HTMLParser):
             if match:
                 return i
 
+    def resolve_style(self, attrs, parent):
+        """
+        Memoized element_style()
+
+        :type attrs: dict
+        :type parent: tuple
+
+        :returns: (style id, style, emphasis, fixed width font) of the
+        element. Elements without class or style attributes share the
+        tuple of their parent.
+        :rtype: tuple
+        """
+        css_class = attrs.get('class')
+        css_style = attrs.get('style')
+        if css_class is None and css_style is None:
+            return parent
+        key = (parent[0], css_class, css_style)
+        resolved = self.style_cache.get(key)
+        if resolved is None:
+            if len(self.style_cache) >= STYLE_CACHE_SIZE:
+                self.style_cache.clear()
+            style = element_style(attrs, self.style_def, parent[1])
+            resolved = (next(style_ids), style, google_text_emphasis(style),
+                        google_fixed_width_font(style))
+            self.style_cache[key] = resolved
+        return resolved
+
     def handle_emphasis(self, start, tag_style, parent_style):
         """
         Handles various text emphases
+
+        :type tag_style: tuple
+        :type parent_style: tuple
         """
-        tag_emphasis = google_text_emphasis(tag_style)
-        parent_emphasis = google_text_emphasis(parent_style)
+        tag_emphasis = tag_style[2]
+        parent_emphasis = parent_style[2]
 
         # handle Google's text emphasis
         strikethrough = 'line-through' in \
                         tag_emphasis and self.hide_strikethrough
-        bold = 'bold' in tag_emphasis and not 'bold' in parent_emphasis
-        italic = 'italic' in tag_emphasis and not 'italic' in parent_emphasis
-        fixed = google_fixed_width_font(tag_style) and not \
-            google_fixed_width_font(parent_style) and not self.pre
-        spoiler = 'spoiler' in tag_emphasis and not 'spoiler' in parent_emphasis
-        quote = 'quote' in tag_emphasis and not 'quote' in parent_emphasis
+        if tag_style is parent_style:
+            # nothing can start or stop on an element without own style
+            if not strikethrough:
+                return
+            bold = italic = fixed = spoiler = quote = False
+        else:
+            bold = 'bold' in tag_emphasis and not 'bold' in parent_emphasis
+            italic = 'italic' in tag_emphasis and not 'italic' in parent_emphasis
+            fixed = tag_style[3] and not parent_style[3] and not self.pre
+            spoiler = 'spoiler' in tag_emphasis and not 'spoiler' in parent_emphasis
+            quote = 'quote' in tag_emphasis and not 'quote' in parent_emphasis
 
         if start:
             # crossed-out text must be handled before other attributes
@@ -692,290 +1142,350 @@ class HTML2Text(HTMLParser.HTMLParser):
 
     def handle_tag(self, tag, attrs, start):
         # attrs is None for endtags
-        if attrs is None:
-            attrs = {}
-        else:
+        if attrs:
             attrs = dict(attrs)
+        else:
+            # shared, handlers only write to attrs carrying href or src
+            attrs = NO_ATTRS
 
+        tag_style = parent_style = None
         if self.google_doc:
             # the attrs parameter is empty for a closing tag. in addition, we
             # need the attributes of the parent nodes in order to get a
             # complete style description for the current element. we assume
             # that google docs export well formed html.
-            parent_style = {}
+            parent_style = ROOT_STYLE
             if start:
                 if self.tag_stack:
                     parent_style = self.tag_stack[-1][2]
-                tag_style = element_style(attrs, self.style_def, parent_style)
+                tag_style = self.resolve_style(attrs, parent_style)
                 self.tag_stack.append((tag, attrs, tag_style))
             else:
                 dummy, attrs, tag_style = self.tag_stack.pop()
                 if self.tag_stack:
                     parent_style = self.tag_stack[-1][2]
 
-        if hn(tag):
-            self.p()
-            if start:
-                self.inheader = True
-                self.o(hn(tag) * "#" + ' ')
-            else:
-                self.inheader = False
-                return  # prevent redundant emphasis marks on headers
+        handler = self.tags_before_emphasis.get(tag)
+        if handler is not None and handler(self, tag, attrs, start, tag_style):
+            return
 
-        if tag in ['p', 'div']:
-            if self.google_doc:
-                if start and google_has_height(tag_style):
-                    self.p()
-                else:
-                    self.soft_br()
-            else:
+        if self.google_doc:
+            if not self.inheader:
+                # handle some font attributes, but leave headers clean
+                self.handle_emphasis(start, tag_style, parent_style)
+
+        handler = self.tags_after_emphasis.get(tag)
+        if handler is not None and handler(self, tag, attrs, start, tag_style):
+            return
+
+        if tag != 'ol' and tag != 'ul':
+            self.lastWasList = False
+
+    # Tag handlers below get the element style tuple (or None without
+    # google_doc) and return True to stop any further processing of the tag.
+
+    def tag_header(self, tag, attrs, start, tag_style):
+        self.p()
+        if start:
+            self.inheader = True
+            self.o(hn(tag) * "#" + ' ')
+        else:
+            self.inheader = False
+            return True  # prevent redundant emphasis marks on headers
+
+    def tag_paragraph(self, tag, attrs, start, tag_style):
+        if self.google_doc:
+            if start and google_has_height(tag_style[1]):
                 self.p()
+            else:
+                self.soft_br()
+        else:
+            self.p()
 
-        if tag == "br" and start:
+    def tag_br(self, tag, attrs, start, tag_style):
+        if start:
             self.o("  \n")
 
-        if tag == "hr" and start:
+    def tag_hr(self, tag, attrs, start, tag_style):
+        if start:
             self.p()
             self.o("* * *")
             self.p()
 
-        if tag in ["head", "style", 'script']:
-            if start:
-                self.quiet += 1
-            else:
-                self.quiet -= 1
+    def tag_quiet(self, tag, attrs, start, tag_style):
+        if start:
+            self.quiet += 1
+        else:
+            self.quiet -= 1
 
-        if tag == "style":
-            if start:
-                self.style += 1
-            else:
-                self.style -= 1
+    def tag_stylesheet(self, tag, attrs, start, tag_style):
+        if start:
+            self.quiet += 1
+            self.style += 1
+        else:
+            self.quiet -= 1
+            self.style -= 1
 
-        if tag in ["body"]:
-            self.quiet = 0  # sites like 9rules.com never close <head>
+    def tag_body(self, tag, attrs, start, tag_style):
+        self.quiet = 0  # sites like 9rules.com never close <head>
 
-        if tag == "blockquote":
-            if start:
-                self.p()
-                self.o('> ', 0, 1)
-                self.start = 1
-                self.blockquote += 1
-            else:
-                self.blockquote -= 1
-                self.p()
+    def tag_blockquote(self, tag, attrs, start, tag_style):
+        if start:
+            self.p()
+            self.o('> ', 0, 1)
+            self.start = 1
+            self.blockquote += 1
+        else:
+            self.blockquote -= 1
+            self.p()
 
-        if tag in ['em', 'i', 'u'] and not self.ignore_emphasis:
+    def tag_em(self, tag, attrs, start, tag_style):
+        if not self.ignore_emphasis:
             self.o(self.emphasis_start_mark) if start else self.o(self.emphasis_stop_mark)
-        if tag in ['strong', 'b'] and not self.ignore_emphasis:
+
+    def tag_strong(self, tag, attrs, start, tag_style):
+        if not self.ignore_emphasis:
             self.o(self.strong_start_mark) if start else self.o(self.strong_stop_mark)
-        if tag in ['del', 'strike', 's']:
-            if start:
-                self.o("<" + tag + ">")
-            else:
-                self.o("</" + tag + ">")
 
-        if self.google_doc:
-            if not self.inheader:
-                # handle some font attributes, but leave headers clean
-                self.handle_emphasis(start, tag_style, parent_style)
+    def tag_del(self, tag, attrs, start, tag_style):
+        if start:
+            self.o("<" + tag + ">")
+        else:
+            self.o("</" + tag + ">")
 
-        if tag in ["code", "tt"] and not self.pre:
+    def tag_code(self, tag, attrs, start, tag_style):
+        if not self.pre:
             self.o('`')  # TODO: `` `this` ``
             self.code = not self.code
-        if tag == "abbr":
-            if start:
+
+    def tag_abbr(self, tag, attrs, start, tag_style):
+        if start:
+            self.abbr_title = None
+            self.abbr_data = ''
+            if ('title' in attrs):
+                self.abbr_title = attrs['title']
+        else:
+            if self.abbr_title is not None:
+                self.abbr_list[self.abbr_data] = self.abbr_title
                 self.abbr_title = None
-                self.abbr_data = ''
-                if ('title' in attrs):
-                    self.abbr_title = attrs['title']
-            else:
-                if self.abbr_title is not None:
-                    self.abbr_list[self.abbr_data] = self.abbr_title
-                    self.abbr_title = None
-                self.abbr_data = ''
+            self.abbr_data = ''
 
-        if tag == "a" and not self.ignore_links:
-            if start:
-                if ('href' in attrs) and \
-                        (attrs['href'] is not None) and \
-                        not (self.skip_internal_links and
-                                 attrs['href'].startswith('#')):
-                    self.astack.append(attrs)
-                    self.maybe_automatic_link = attrs['href']
-                    self.empty_link = True
-                    if self.protect_links:
-                        attrs['href'] = '<'+attrs['href']+'>'
-                else:
-                    self.astack.append(None)
+    def tag_a(self, tag, attrs, start, tag_style):
+        if self.ignore_links:
+            return
+        if start:
+            if ('href' in attrs) and \
+                    (attrs['href'] is not None) and \
+                    not (self.skip_internal_links and
+                             attrs['href'].startswith('#')):
+                self.astack.append(attrs)
+                self.maybe_automatic_link = attrs['href']
+                self.empty_link = True
+                if self.protect_links:
+                    attrs['href'] = '<'+attrs['href']+'>'
             else:
-                if self.astack:
-                    a = self.astack.pop()
-                    if self.maybe_automatic_link and not self.empty_link:
-                        self.maybe_automatic_link = None
-                    elif a:
-                        if self.empty_link:
-                            self.o("[")
-                            self.empty_link = False
-                            self.maybe_automatic_link = None
-                        if self.inline_links:
-                            self.o("](" + escape_md(a['href']) + ")")
-                        else:
-                            i = self.previousIndex(a)
-                            if i is not None:
-                                a = self.a[i]
-                            else:
-                                self.acount += 1
-                                a['count'] = self.acount
-                                a['outcount'] = self.outcount
-                                self.a.append(a)
-                            self.o("][" + str(a['count']) + "]")
-
-        if tag == "img" and start and not self.ignore_images:
-            if 'src' in attrs:
-                if not self.images_to_alt:
-                    attrs['href'] = attrs['src']
-                alt = attrs.get('alt') or ''
-
-                # If we have images_with_size, write raw html including width,
-                # height, and alt attributes
-                if self.images_with_size and \
-                        ("width" in attrs or "height" in attrs):
-                    self.o("<img src='" + attrs["src"] + "' ")
-                    if "width" in attrs:
-                        self.o("width='" + attrs["width"] + "' ")
-                    if "height" in attrs:
-                        self.o("height='" + attrs["height"] + "' ")
-                    if alt:
-                        self.o("alt='" + alt + "' ")
-                    self.o("/>")
-                    return
-
-                # If we have a link to create, output the start
-                if not self.maybe_automatic_link is None:
-                    href = self.maybe_automatic_link
-                    if self.images_to_alt and escape_md(alt) == href and \
-                            self.absolute_url_matcher.match(href):
-                        self.o("<" + escape_md(alt) + ">")
-                        self.empty_link = False
-                        return
-                    else:
+                self.astack.append(None)
+        else:
+            if self.astack:
+                a = self.astack.pop()
+                if self.maybe_automatic_link and not self.empty_link:
+                    self.maybe_automatic_link = None
+                elif a:
+                    if self.empty_link:
                         self.o("[")
-                        self.maybe_automatic_link = None
                         self.empty_link = False
-
-                # If we have images_to_alt, we discard the image itself,
-                # considering only the alt text.
-                if self.images_to_alt:
-                    self.o(escape_md(alt))
-                else:
-                    self.o("![" + escape_md(alt) + "]")
+                        self.maybe_automatic_link = None
                     if self.inline_links:
-                        href = attrs.get('href') or ''
-                        self.o("(" + escape_md(href) + ")")
+                        self.o("](" + escape_md(a['href']) + ")")
                     else:
-                        i = self.previousIndex(attrs)
+                        i = self.previousIndex(a)
                         if i is not None:
-                            attrs = self.a[i]
+                            a = self.a[i]
                         else:
                             self.acount += 1
-                            attrs['count'] = self.acount
-                            attrs['outcount'] = self.outcount
-                            self.a.append(attrs)
-                        self.o("[" + str(attrs['count']) + "]")
+                            a['count'] = self.acount
+                            a['outcount'] = self.outcount
+                            self.a.append(a)
+                        self.o("][" + str(a['count']) + "]")
+
+    def tag_img(self, tag, attrs, start, tag_style):
+        if not start or self.ignore_images or 'src' not in attrs:
+            return
+        if not self.images_to_alt:
+            attrs['href'] = attrs['src']
+        alt = attrs.get('alt') or ''
+
+        # If we have images_with_size, write raw html including width,
+        # height, and alt attributes
+        if self.images_with_size and \
+                ("width" in attrs or "height" in attrs):
+            self.o("<img src='" + attrs["src"] + "' ")
+            if "width" in attrs:
+                self.o("width='" + attrs["width"] + "' ")
+            if "height" in attrs:
+                self.o("height='" + attrs["height"] + "' ")
+            if alt:
+                self.o("alt='" + alt + "' ")
+            self.o("/>")
+            return True
+
+        # If we have a link to create, output the start
+        if not self.maybe_automatic_link is None:
+            href = self.maybe_automatic_link
+            if self.images_to_alt and escape_md(alt) == href and \
+                    self.absolute_url_matcher.match(href):
+                self.o("<" + escape_md(alt) + ">")
+                self.empty_link = False
+                return True
+            else:
+                self.o("[")
+                self.maybe_automatic_link = None
+                self.empty_link = False
+
+        # If we have images_to_alt, we discard the image itself,
+        # considering only the alt text.
+        if self.images_to_alt:
+            self.o(escape_md(alt))
+        else:
+            self.o("![" + escape_md(alt) + "]")
+            if self.inline_links:
+                href = attrs.get('href') or ''
+                self.o("(" + escape_md(href) + ")")
+            else:
+                i = self.previousIndex(attrs)
+                if i is not None:
+                    attrs = self.a[i]
+                else:
+                    self.acount += 1
+                    attrs['count'] = self.acount
+                    attrs['outcount'] = self.outcount
+                    self.a.append(attrs)
+                self.o("[" + str(attrs['count']) + "]")
 
-        if tag == 'dl' and start:
+    def tag_dl(self, tag, attrs, start, tag_style):
+        if start:
             self.p()
-        if tag == 'dt' and not start:
+
+    def tag_dt(self, tag, attrs, start, tag_style):
+        if not start:
             self.pbr()
-        if tag == 'dd' and start:
+
+    def tag_dd(self, tag, attrs, start, tag_style):
+        if start:
             self.o('    ')
-        if tag == 'dd' and not start:
+        else:
             self.pbr()
 
-        if tag in ["ol", "ul"]:
-            # Google Docs create sub lists as top level lists
-            if (not self.list) and (not self.lastWasList):
-                self.p()
-            if start:
-                if self.google_doc:
-                    list_style = google_list_style(tag_style)
-                else:
-                    list_style = tag
-                numbering_start = list_numbering_start(attrs)
-                self.list.append({
-                    'name': list_style,
-                    'num': numbering_start
-                })
+    def tag_list(self, tag, attrs, start, tag_style):
+        # Google Docs create sub lists as top level lists
+        if (not self.list) and (not self.lastWasList):
+            self.p()
+        if start:
+            if self.google_doc:
+                list_style = google_list_style(tag_style[1])
             else:
-                if self.list:
-                    self.list.pop()
-            self.lastWasList = True
+                list_style = tag
+            numbering_start = list_numbering_start(attrs)
+            self.list.append({
+                'name': list_style,
+                'num': numbering_start
+            })
         else:
-            self.lastWasList = False
+            if self.list:
+                self.list.pop()
+        self.lastWasList = True
 
-        if tag == 'li':
-            self.pbr()
+    def tag_li(self, tag, attrs, start, tag_style):
+        self.pbr()
+        if start:
+            if self.list:
+                li = self.list[-1]
+            else:
+                li = {'name': 'ul', 'num': 0}
+            if self.google_doc:
+                nest_count = self.google_nest_count(tag_style[1])
+            else:
+                nest_count = len(self.list)
+            # TODO: line up <ol><li>s > 9 correctly.
+            self.o("  " * nest_count)
+            if li['name'] == "ul":
+                self.o(self.ul_item_mark + " ")
+            elif li['name'] == "ol":
+                li['num'] += 1
+                self.o(str(li['num']) + ". ")
+            self.start = 1
+
+    def tag_table(self, tag, attrs, start, tag_style):
+        if self.bypass_tables:
             if start:
-                if self.list:
-                    li = self.list[-1]
-                else:
-                    li = {'name': 'ul', 'num': 0}
-                if self.google_doc:
-                    nest_count = self.google_nest_count(tag_style)
+                self.soft_br()
+            if tag in ["td", "th"]:
+                if start:
+                    self.o('<{0}>\n\n'.format(tag))
                 else:
-                    nest_count = len(self.list)
-                # TODO: line up <ol><li>s > 9 correctly.
-                self.o("  " * nest_count)
-                if li['name'] == "ul":
-                    self.o(self.ul_item_mark + " ")
-                elif li['name'] == "ol":
-                    li['num'] += 1
-                    self.o(str(li['num']) + ". ")
-                self.start = 1
-
-        if tag in ["table", "tr", "td", "th"]:
-            if self.bypass_tables:
+                    self.o('\n</{0}>'.format(tag))
+            else:
                 if start:
-                    self.soft_br()
-                if tag in ["td", "th"]:
-                    if start:
-                        self.o('<{0}>\n\n'.format(tag))
-                    else:
-                        self.o('\n</{0}>'.format(tag))
+                    self.o('<{0}>'.format(tag))
                 else:
-                    if start:
-                        self.o('<{0}>'.format(tag))
-                    else:
-                        self.o('</{0}>'.format(tag))
+                    self.o('</{0}>'.format(tag))
 
-            else:
-                if tag == "table" and start:
-                    self.table_start = True
-                if tag in ["td", "th"] and start:
-                    if self.split_next_td:
-                        self.o("| ")
-                    self.split_next_td = True
-
-                if tag == "tr" and start:
-                    self.td_count = 0
-                if tag == "tr" and not start:
-                    self.split_next_td = False
-                    self.soft_br()
-                if tag == "tr" and not start and self.table_start:
-                    # Underline table header
-                    self.o("|".join(["---"] * self.td_count))
-                    self.soft_br()
-                    self.table_start = False
-                if tag in ["td", "th"] and start:
-                    self.td_count += 1
-
-        if tag == "pre":
-            if start:
-                self.startpre = 1
-                self.pre = 1
-            else:
-                self.pre = 0
-            self.p()
+        else:
+            if tag == "table" and start:
+                self.table_start = True
+            if tag in ["td", "th"] and start:
+                if self.split_next_td:
+                    self.o("| ")
+                self.split_next_td = True
+
+            if tag == "tr" and start:
+                self.td_count = 0
+            if tag == "tr" and not start:
+                self.split_next_td = False
+                self.soft_br()
+            if tag == "tr" and not start and self.table_start:
+                # Underline table header
+                self.o("|".join(["---"] * self.td_count))
+                self.soft_br()
+                self.table_start = False
+            if tag in ["td", "th"] and start:
+                self.td_count += 1
+
+    def tag_pre(self, tag, attrs, start, tag_style):
+        if start:
+            self.startpre = 1
+            self.pre = 1
+        else:
+            self.pre = 0
+        self.p()
+
+    tags_before_emphasis = {
+        'p': tag_paragraph, 'div': tag_paragraph,
+        'br': tag_br,
+        'hr': tag_hr,
+        'head': tag_quiet, 'script': tag_quiet,
+        'style': tag_stylesheet,
+        'body': tag_body,
+        'blockquote': tag_blockquote,
+        'em': tag_em, 'i': tag_em, 'u': tag_em,
+        'strong': tag_strong, 'b': tag_strong,
+        'del': tag_del, 'strike': tag_del, 's': tag_del,
+    }
+    for n in range(1, 10):
+        tags_before_emphasis['h%d' % n] = tag_header
+    del n
+
+    tags_after_emphasis = {
+        'code': tag_code, 'tt': tag_code,
+        'abbr': tag_abbr,
+        'a': tag_a,
+        'img': tag_img,
+        'dl': tag_dl, 'dt': tag_dt, 'dd': tag_dd,
+        'ol': tag_list, 'ul': tag_list,
+        'li': tag_li,
+        'table': tag_table, 'tr': tag_table, 'td': tag_table, 'th': tag_table,
+        'pre': tag_pre,
+    }
 
     def pbr(self):
         if self.p_p == 0:
@@ -1009,7 +1519,7 @@ class HTML2Text(HTMLParser.HTMLParser):
                 # This is a very dangerous call ... it could mess up
                 # all handling of &nbsp; when not handled properly
                 # (see entityref)
-                data = re.sub(r'\s+', r' ', data)
+                data = RE_WHITESPACE.sub(' ', data)
                 if data and data[0] == ' ':
                     self.space = 1
                     data = data[1:]
@@ -1096,6 +1606,7 @@ class HTML2Text(HTMLParser.HTMLParser):
 
         if self.style:
             self.style_def.update(dumb_css_parser(data))
+            self.style_cache = {}
 
         if not self.maybe_automatic_link is None:
             href = self.maybe_automatic_link
@@ -1121,30 +1632,24 @@ class HTML2Text(HTMLParser.HTMLParser):
         else:
             c = int(name)
 
-        if not self.unicode_snob and c in unifiable_n.keys():
+        if not self.unicode_snob and c in unifiable_n:
             return unifiable_n[c]
         else:
-            try:
-                return unichr(c)
-            except NameError:  # Python3
-                return chr(c)
+            return unichr(c)
 
     def entityref(self, c):
-        if not self.unicode_snob and c in UNIFIABLE.keys():
+        if not self.unicode_snob and c in UNIFIABLE:
             return UNIFIABLE[c]
         else:
             try:
-                name2cp(c)
+                cp = name2cp(c)
             except KeyError:
                 return "&" + c + ';'
             else:
                 if c == 'nbsp':
                     return UNIFIABLE[c]
                 else:
-                    try:
-                        return unichr(name2cp(c))
-                    except NameError:  # Python3
-                        return chr(name2cp(c))
+                    return unichr(cp)
 
     def replaceEntities(self, s):
         s = s.group(1)
@@ -1182,18 +1687,17 @@ class HTML2Text(HTMLParser.HTMLParser):
         if not self.body_width:
             return text
 
-        assert wrap, "Requires Python 2.3."
-        result = ''
+        result = []
         newlines = 0
         for para in text.split("\n"):
             if len(para) > 0:
                 if not skipwrap(para):
-                    result += "\n".join(wrap(para, self.body_width))
+                    result.append("\n".join(wrap(para, self.body_width)))
                     if para.endswith('  '):
-                        result += "  \n"
+                        result.append("  \n")
                         newlines = 1
                     else:
-                        result += "\n\n"
+                        result.append("\n\n")
                         newlines = 2
                 else:
                     # Warning for the tempted!!!
@@ -1201,23 +1705,46 @@ class HTML2Text(HTMLParser.HTMLParser):
                     # line.isspace()
                     # DOES NOT work! Explanations are welcome.
                     if not RE_SPACE.match(para):
-                        result += para + "\n"
+                        result.append(para)
+                        result.append("\n")
                         newlines = 1
             else:
                 if newlines < 2:
-                    result += "\n"
+                    result.append("\n")
                     newlines += 1
-        return result
+        return "".join(result)
 
-def html2text(s):
+def html2text(s, plain=False, width=None):
+    """
+    Converts a post to terminal text, wrapped at BODY_WIDTH unless width
+    is given.
+    """
+    started = time.time() if metrics is not None else None
     h2t = HTML2Text(baseurl=BASE_URL)
     h2t.body_width=0
-    return h2t.unescape(h2t.handle(s))
+    if plain:
+        h2t.emphasis_start_mark = h2t.emphasis_stop_mark = ''
+        h2t.strong_start_mark = h2t.strong_stop_mark = ''
+        h2t.spoiler_start_mark = h2t.spoiler_stop_mark = ''
+        h2t.quote_start_mark = h2t.quote_stop_mark = ''
+    text = h2t.handle(s)
+    if '&' in text:
+        text = h2t.unescape(text)
+    if width is None:
+        width = BODY_WIDTH
+    if width:
+        # wrap after unescaping so entities are measured as printed, and
+        # keep the single trailing newline of unwrapped output
+        h2t.body_width = width
+        text = h2t.optwrap(text).rstrip('\n') + '\n'
+    if started is not None:
+        metrics.observe('sosuch_html2text_seconds', time.time() - started)
+    return text
 
 # ---------------------
 # --- Sosuch parser ---
 # ---------------------
-def print_post(p, board):
+def format_post(p, board):
     banned = STYLE_BANNED + ("[banned]" if p["banned"] == 1 else "") + STYLE_RESET
     sticky = STYLE_STICKY + ("[sticky]" if p["sticky"] == 1 else "") + STYLE_RESET
     closed = STYLE_CLOSED + ("[closed]" if p["closed"] == 1 else "") + STYLE_RESET
@@ -1226,117 +1753,2400 @@ def print_post(p, board):
     name = STYLE_NAME + p["name"] + " " + STYLE_RESET
     email = (STYLE_EMAIL + "<" + p["email"] + "> " + STYLE_RESET) if p["email"] else ""
     date = STYLE_DATE + p["date"] + STYLE_RESET
-    print ("%s%s%s%s %s %s%s%s" % (subj, name, email, date, num, banned, sticky, closed))
+    lines = ["%s%s%s%s %s %s%s%s" % (subj, name, email, date, num, banned, sticky, closed)]
     for f in p["files"]:
-        print ((STYLE_IMGS + "%s/%s/%s" + STYLE_RESET) % (BASE_URL, board, f["path"]))
-    print(html2text(p["comment"]))
-
-def resolve_captcha():
-    CAPTCHA_URL = '%s/makaba/captcha.fcgi' % BASE_URL
-    resp = http.request('GET', CAPTCHA_URL, fields={'type': '2chaptcha', 'action': 'thread'})
-    if resp.status == 200:
-        data = resp.data.decode('utf-8')
-        _, captcha_id = data.split('\n')
-        CAPTCHA_IMG_URL = '%s/makaba/captcha.fcgi' % BASE_URL
-        resp = http.request('GET', CAPTCHA_IMG_URL, fields={'type': '2chaptcha', 'action': 'image', 'id': captcha_id})
-        img = resp.data
-        _, fn = mkstemp(suffix='png')
-        with open(fn, 'wb') as f:
-            f.write(img)
-        p = check_output([CAPTCHA_RESOLVE_SCRIPT, captcha_id, fn]).decode('utf-8')
-        os.remove(fn)
-        return (p.strip(), captcha_id)
-    return None
+        lines.append((STYLE_IMGS + "%s/%s/%s" + STYLE_RESET) % (BASE_URL, board, f["path"]))
+    lines.append(html2text(p["comment"]))
+    return "\n".join(lines) + "\n"
+
+def plain_header(p):
+    flags = "".join("[%s]" % flag for flag in ("banned", "sticky", "closed") if p[flag] == 1)
+    subj = (html2text(p["subject"], plain=True, width=0).strip() + " ") if p["subject"] != "" else ""
+    email = ("<" + p["email"] + "> ") if p["email"] else ""
+    return "%s%s %s%s >>%s %s" % (subj, p["name"], email, p["date"], p["num"], flags)
+
+def format_post_plain(p, board):
+    lines = [plain_header(p)]
+    for f in p["files"]:
+        lines.append("%s/%s/%s" % (BASE_URL, board, f["path"]))
+    lines.append(html2text(p["comment"], plain=True))
+    return "\n".join(lines) + "\n"
 
-def threads(board):
-    URL = '%s/%s/catalog.json' % (BASE_URL, board)
-    resp = http.request('GET', URL)
-    if resp.status == 200:
-        data = loads(resp.data.decode('utf-8'))
-        threads = data["threads"]
-        for t in threads:
-            summary = STYLE_SUMMARY + (("Пропущено постов %d из них %d с картинками" % (t["posts_count"], t["files_count"])) if t["posts_count"] != 0 else "")  + STYLE_RESET
-            print_post(t, board)
-            print(summary)
-            print("-" * 80)
-    else:
-        print("Error %d" % resp.status)
-    
-def posts(board, thread):
-    URL = '%s/%s/res/%s.json' % (BASE_URL, board, thread)
-    resp = http.request('GET', URL)
-    if resp.status == 200:
-        data = loads(resp.data.decode('utf-8'))
-        posts = data["threads"][0]["posts"]
-        for p in posts:
-            print_post(p, board)
-            print("-" * 80)
+def post_record(p, board, text=False):
+    """
+    Compact machine-readable representation of a post or a catalog thread.
+    Comment is left as raw HTML unless converted text is asked for.
+    """
+    rec = {'board': board}
+    for k in RECORD_KEYS:
+        if k in p:
+            rec[k] = p[k]
+    rec['files'] = [dict((k, f[k]) for k in RECORD_FILE_KEYS if k in f)
+                    for f in p.get("files") or []]
+    if text:
+        rec['text'] = html2text(p["comment"], plain=True, width=0)
+    return rec
+
+def format_post_jsonl(p, board, text=False):
+    return dumps(post_record(p, board, text), ensure_ascii=False, separators=(',', ':'))
+
+def render_post(p, board, fmt='text', text=False, summary=False, quotes=None):
+    """
+    :returns: The post as written in the given output format, catalog
+    threads with omitted posts summary and previews of posts quoted from
+    other threads when asked for
+    :rtype: str
+    """
+    if metrics is not None:
+        metrics.inc('sosuch_posts_rendered_total', format=fmt)
+    previews = quote_previews(p, board, quotes) if quotes else []
+    if fmt == 'jsonl':
+        if not previews:
+            return format_post_jsonl(p, board, text) + "\n"
+        rec = post_record(p, board, text)
+        rec['quotes'] = [{'board': b, 'num': n, 'text': t} for b, n, t in previews]
+        return dumps(rec, ensure_ascii=False, separators=(',', ':')) + "\n"
+    if fmt == 'plain':
+        out = format_post_plain(p, board)
     else:
-        print("Error %d" % (resp.status))
+        out = format_post(p, board)
+    for b, n, t in previews:
+        t = " ".join(t.split())
+        if len(t) > QUOTE_PREVIEW_LEN:
+            t = t[:QUOTE_PREVIEW_LEN - 3] + "..."
+        line = "  >>%s%d: %s" % ("" if b == board else "/%s/" % b, n, t)
+        out += (line if fmt == 'plain' else STYLE_SUMMARY + line + STYLE_RESET) + "\n"
+    if summary:
+        line = ("Пропущено постов %d из них %d с картинками" % (p["posts_count"], p["files_count"])) if p["posts_count"] != 0 else ""
+        out += (line if fmt == 'plain' else STYLE_SUMMARY + line + STYLE_RESET) + "\n"
+    return out + "-" * 80 + "\n"
+
+def quoted_refs(posts, board, thread=None):
+    """
+    :returns: (board, thread, num) of posts referenced from the given posts
+    but not among them, leaving out references into the shown thread
+    (deleted posts) when given
+    :rtype: set
+    """
+    have = set(p["num"] for p in posts)
+    refs = set()
+    for p in posts:
+        for b, t, n in RE_REPLY_HREF.findall(p["comment"]):
+            if b == board and (int(n) in have or t == str(thread)):
+                continue
+            refs.add((b, t, int(n)))
+    return refs
+
+def fetch_quoted_thread(board, thread):
+    try:
+        return get_json(board, 'res/%s.json' % thread)
+    except HTTPError:
+        return None, None
 
-def post(board, thread, comment, captcha_id, captcha_value, subject=None, name=None, email=None, images=None):
-    query_fields = {'json': '1',
-                    'task': 'post',
-                    'captcha_type': '2chaptcha',
-                    'board': board,
-                    'thread': thread,
-                    '2chaptcha_id': captcha_id,
-                    '2chaptcha_value': captcha_value}
-    encoded_fields = urlencode(query_fields)
-    URL = '%s/makaba/posting.fcgi?%s' % (BASE_URL, encoded_fields)
-    fields = {'comment': comment}
-    if email:
-        fields['email'] = email
-    if name:
-        fields['name'] = name
-    if subject:
-        fields['subject'] = subject
-    if images:
-        for i in range(min(len(images),4)):
-            fields['image%d' % i] = ('yourmom%d.png' % i, images[i])
-    resp = http.request('POST', URL, fields=fields)
-    data = loads(resp.data.decode('utf-8'))
-    if ('Status' in data) and (data['Status'] == 'OK' or data['Status'] == 'Redirect'):
-        print('OK: %s' % data['Num'])
-        return True
-    else:
-        print('Error: %d %s' % (data['Error'], data['Reason']))
-        return False
+def resolve_quotes(refs, offline=False):
+    """
+    Looks quoted posts up in their threads, each thread fetched once. The
+    mirror and its archive are tried first, then at most QUOTE_MAX_THREADS
+    threads missing there or missing some quoted posts are fetched from
+    the site concurrently.
+
+    :returns: Quoted posts by (board, num)
+    :rtype: dict
+    """
+    wanted = set((b, n) for b, t, n in refs)
+    found = {}
+    remote = []
+
+    def collect(board, data):
+        for p in data["threads"][0]["posts"]:
+            if (board, p["num"]) in wanted:
+                found[(board, p["num"])] = p
+
+    for board, thread in sorted(set((b, t) for b, t, n in refs)):
+        status, data = get_json(board, 'res/%s.json' % thread, offline=True)
+        if status == 200:
+            collect(board, data)
+        if status != 200 or any((b, n) not in found for b, t, n in refs if (b, t) == (board, thread)):
+            remote.append((board, thread))
+    remote = [] if offline else remote[:QUOTE_MAX_THREADS]
+    if remote:
+        with ThreadPoolExecutor(QUOTE_WORKERS) as pool:
+            for (board, thread), (status, data) in zip(remote, pool.map(lambda bt: fetch_quoted_thread(*bt), remote)):
+                if status == 200:
+                    collect(board, data)
+    return found
+
+def quote_previews(p, board, quotes):
+    """
+    :returns: (board, num, converted text) for posts quoted by p which were
+    resolved from other threads
+    :rtype: list
+    """
+    previews = []
+    seen = set()
+    for b, t, n in RE_REPLY_HREF.findall(p["comment"]):
+        key = (b, int(n))
+        if key in quotes and key not in seen:
+            seen.add(key)
+            previews.append((b, key[1], html2text(quotes[key]["comment"], plain=True, width=0)))
+    return previews
+
+def show_post(p, board, fmt='text', text=False):
+    sys.stdout.write(render_post(p, board, fmt, text))
+    sys.stdout.flush()
+
+def page(chunks, fmt='text'):
+    """
+    Writes rendered chunks through PAGER when stdout is a terminal, to
+    stdout otherwise. Chunks are rendered lazily as they are written, so
+    rendering blocks while the pager is not reading and stops once it
+    quits or stdout is closed.
+    """
+    pager = None
+    out = sys.stdout
+    if PAGER and fmt != 'jsonl' and sys.stdout.isatty():
+        if hasattr(sys.stdout, 'page'):
+            # running in the daemon, the client starts the pager
+            sys.stdout.page(PAGER)
+        else:
+            env = dict(os.environ)
+            env.setdefault('LESS', 'FRX')
+            pager = Popen(PAGER, shell=True, stdin=PIPE, env=env)
+            out = TextIOWrapper(pager.stdin, encoding='utf-8')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+            out.flush()
+    except BrokenPipeError:
+        if pager is None and sys.stdout is sys.__stdout__:
+            # keep the interpreter from failing on stdout flush at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except KeyboardInterrupt:
+        if pager is None:
+            raise
+    finally:
+        if pager is not None:
+            try:
+                out.close()
+            except BrokenPipeError:
+                pass
+            pager.wait()
+
+class Scheduler(object):
+    """
+    Token buckets per host shared by every HTTP request, see request().
+    Waiting requests are let through by priority class and then in order
+    of arrival; a host answering 429 or 503 is paused for its Retry-After
+    or an exponentially growing delay.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.hosts = {}
+        self.seq = count()
+
+    def host(self, name):
+        if name not in self.hosts:
+            self.hosts[name] = {'tokens': rate_limit(name)[1], 'stamp': time.time(),
+                                'waiting': [], 'blocked': 0, 'failures': 0}
+        return self.hosts[name]
+
+    def acquire(self, name, priority):
+        with self.cond:
+            h = self.host(name)
+            entry = (priority, next(self.seq))
+            heappush(h['waiting'], entry)
+            try:
+                while True:
+                    now = time.time()
+                    rate, burst = rate_limit(name)
+                    h['tokens'] = min(burst, h['tokens'] + (now - h['stamp']) * rate)
+                    h['stamp'] = now
+                    if h['waiting'][0] == entry and now >= h['blocked'] and (rate <= 0 or h['tokens'] >= 1):
+                        heappop(h['waiting'])
+                        h['tokens'] -= 1
+                        return
+                    if h['waiting'][0] != entry:
+                        timeout = RATE_MAX_WAIT
+                    elif now < h['blocked']:
+                        timeout = h['blocked'] - now
+                    else:
+                        timeout = (1 - h['tokens']) / rate
+                    self.cond.wait(min(timeout, RATE_MAX_WAIT))
+            finally:
+                # an interrupted waiter must not block the queue behind it
+                if entry in h['waiting']:
+                    h['waiting'].remove(entry)
+                    heapify(h['waiting'])
+                self.cond.notify_all()
+
+    def report(self, name, status, retry_after=None):
+        with self.cond:
+            h = self.host(name)
+            if status in RATE_BACKOFF_STATUS:
+                if time.time() < h['blocked'] and retry_after is None:
+                    # sent before the host was paused
+                    return
+                h['failures'] += 1
+                delay = retry_after
+                if delay is None:
+                    delay = min(RATE_BACKOFF_MAX, RATE_BACKOFF * 2 ** (h['failures'] - 1))
+                h['blocked'] = max(h['blocked'], time.time() + delay)
+                h['tokens'] = 0
+            else:
+                h['failures'] = 0
+            self.cond.notify_all()
+
+scheduler = Scheduler()
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms exported in Prometheus text format.
+    Only exists while metrics are enabled (see start_metrics), call sites
+    check for None so disabled metrics cost nothing.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.callbacks = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS_BUCKETS[name]
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def render(self):
+        """
+        :rtype: str
+        """
+        for callback in self.callbacks:
+            callback(self)
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+        fmt_labels = lambda labels: '{%s}' % ','.join('%s="%s"' % l for l in labels) if labels else ''
+        lines = []
+        seen = set()
+        for (name, labels), value in values:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, METRICS_HELP[name]))
+                lines.append('# TYPE %s %s' % (name, 'counter' if name.endswith('_total') else 'gauge'))
+            lines.append('%s%s %s' % (name, fmt_labels(labels), repr(float(value))))
+        for (name, labels), h in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, METRICS_HELP[name]))
+                lines.append('# TYPE %s histogram' % name)
+            for le, n in zip(METRICS_BUCKETS[name] + ('+Inf',), h[:-2] + [h[-1]]):
+                lines.append('%s_bucket%s %d' % (name, fmt_labels(labels + (('le', str(le)),)), n))
+            lines.append('%s_sum%s %s' % (name, fmt_labels(labels), repr(float(h[-2]))))
+            lines.append('%s_count%s %d' % (name, fmt_labels(labels), h[-1]))
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def scheduler_gauges(m):
+    with scheduler.cond:
+        now = time.time()
+        for host, h in scheduler.hosts.items():
+            m.set('sosuch_scheduler_waiting', len(h['waiting']), host=host)
+            m.set('sosuch_scheduler_backoff_seconds', max(0, h['blocked'] - now), host=host)
+
+def start_metrics(spec):
+    """
+    Enables metrics, served over HTTP on 127.0.0.1 when spec is a port
+    number (or HOST:PORT) and periodically written to the file otherwise.
+    """
+    global metrics
+    if metrics is not None:
+        return
+    metrics = Metrics()
+    metrics.callbacks.append(scheduler_gauges)
+    host, _, port = spec.rpartition(':')
+    if port.isdigit():
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        fn = os.path.abspath(spec)
+        dump = lambda: write_file(fn, metrics.render().encode('utf-8'))
+        def loop():
+            while True:
+                time.sleep(METRICS_INTERVAL)
+                dump()
+        threading.Thread(target=loop, daemon=True).start()
+        atexit.register(dump)
+
+def endpoint(url):
+    """
+    :returns: Endpoint name of the URL for metrics labels
+    :rtype: str
+    """
+    path = urlparse.urlsplit(url).path
+    if path.endswith('/catalog.json'):
+        return 'catalog'
+    if path.endswith('/threads.json'):
+        return 'index'
+    if '/res/' in path:
+        return 'thread'
+    if path.endswith('/captcha.fcgi'):
+        return 'captcha'
+    if path.endswith('/posting.fcgi'):
+        return 'posting'
+    return 'other'
+
+def rate_limit(host):
+    """
+    :returns: (requests per second, burst) for the host, rate 0 is unlimited
+    :rtype: tuple
+    """
+    return RATE_LIMITS.get(host, RATE_LIMITS['*'])
+
+def parse_rate(spec):
+    """
+    Parses --rate value: [HOST=]RATE[:BURST]
+
+    :returns: (host or '*', (rate, burst))
+    :rtype: tuple
+    """
+    host, _, value = spec.rpartition('=')
+    rate, _, burst = value.partition(':')
+    rate = float(rate)
+    return host or '*', (rate, int(burst) if burst else max(1, int(rate)))
+
+def send(method, url, priority=PRIORITY_INTERACTIVE, rate_retries=RATE_RETRIES, **kwargs):
+    """
+    Issues an HTTP request once the scheduler lets it through. GET requests
+    answered with 429 or 503 are retried after the host's backoff.
+
+    :rtype: urllib3.response.HTTPResponse
+    """
+    host = urlparse.urlsplit(url).netloc
+    for attempt in range(rate_retries + 1):
+        scheduler.acquire(host, priority)
+        started = time.time()
+        try:
+            resp = http.request(method, url, **kwargs)
+        except HTTPError:
+            mirror_report(url, None)
+            raise
+        if resp.status >= 500:
+            mirror_report(url, None)
+        elif resp.status < 400:
+            mirror_report(url, time.time() - started)
+        if metrics is not None:
+            name = endpoint(url)
+            metrics.inc('sosuch_requests_total', endpoint=name, status=resp.status)
+            metrics.observe('sosuch_request_seconds', time.time() - started, endpoint=name)
+            metrics.inc('sosuch_response_bytes_total', len(resp.data), endpoint=name)
+        retry_after = resp.headers.get('Retry-After')
+        retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+        scheduler.report(host, resp.status, retry_after)
+        if method != 'GET' or resp.status not in RATE_BACKOFF_STATUS:
+            break
+    return resp
+
+def site_of(url):
+    for base in [BASE_URL] + MIRRORS:
+        if url.startswith(base + '/'):
+            return base
+    return None
+
+def mirror_report(url, latency):
+    """
+    Records latency of a mirror, None marks it down for MIRROR_DOWN_TIME
+    """
+    base = site_of(url)
+    if base is None:
+        return
+    with mirror_lock:
+        m = mirror_stats.setdefault(base, {'samples': deque(maxlen=MIRROR_SAMPLES), 'latency': None, 'down': 0})
+        if latency is None:
+            m['down'] = time.time() + MIRROR_DOWN_TIME
+        else:
+            m['samples'].append(latency)
+            m['latency'] = latency if m['latency'] is None else \
+                (1 - MIRROR_EWMA) * m['latency'] + MIRROR_EWMA * latency
+            m['down'] = 0
+
+def mirror_order():
+    """
+    :returns: BASE_URL and MIRRORS, mirrors which are up first, then by
+    average latency (unknown counts as MIRROR_DEFAULT_LATENCY)
+    :rtype: list
+    """
+    now = time.time()
+    bases = [BASE_URL] + [m for m in MIRRORS if m != BASE_URL]
+    with mirror_lock:
+        def key(base):
+            m = mirror_stats.get(base)
+            if m is None:
+                return (False, MIRROR_DEFAULT_LATENCY)
+            return (m['down'] > now, MIRROR_DEFAULT_LATENCY if m['latency'] is None else m['latency'])
+        return sorted(bases, key=key)
+
+def hedge_delay(base):
+    """
+    :returns: Time to wait for the mirror before hedging, its p95 latency
+    :rtype: float
+    """
+    with mirror_lock:
+        samples = sorted(mirror_stats.get(base, {}).get('samples', ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+def mirror_down(base):
+    with mirror_lock:
+        return mirror_stats.get(base, {}).get('down', 0) > time.time()
+
+def authoritative(base, resp):
+    """
+    :returns: Whether the answer can be trusted: a success or a client
+    error from BASE_URL, which mirrors lagging behind it may give for new
+    threads
+    :rtype: bool
+    """
+    return resp.status < 400 or (resp.status < 500 and base == BASE_URL)
+
+def hedged(method, primary, secondary, path, priority, **kwargs):
+    """
+    Sends the request to the primary mirror and, if it does not answer
+    within its p95 latency or fails, to the secondary one as well. First
+    trusted answer wins, the slower request is left to finish in a daemon
+    thread.
+
+    :returns: (trusted answer or None, first (mirror, client error) from a
+    mirror or None, last server error or exception)
+    :rtype: tuple
+    """
+    answers = Queue()
+
+    def fire(base):
+        try:
+            answers.put((base, send(method, base + path, priority, 0, **kwargs)))
+        except HTTPError as e:
+            answers.put((base, e))
+
+    threading.Thread(target=fire, args=(primary,), daemon=True).start()
+    pending = 1
+    try:
+        answer = answers.get(timeout=hedge_delay(primary))
+    except Empty:
+        answer = None
+    if answer is None or isinstance(answer[1], HTTPError) or not authoritative(*answer):
+        threading.Thread(target=fire, args=(secondary,), daemon=True).start()
+        pending += 1
+    hedge = pending > 1
+    fallback = failure = None
+    while pending:
+        base, resp = answer or answers.get()
+        answer = None
+        pending -= 1
+        if isinstance(resp, HTTPError) or resp.status >= 500:
+            failure = resp
+        elif authoritative(base, resp):
+            if metrics is not None and hedge:
+                metrics.inc('sosuch_hedged_total', winner='primary' if base == primary else 'secondary')
+            if fallback is not None and resp.status < 400:
+                mirror_report(fallback[0] + path, None)
+            return resp, None, None
+        elif fallback is None:
+            fallback = (base, resp)
+    return None, fallback, failure
+
+def request(method, url, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """
+    Issues an HTTP request, see send(). Reads from the site are sent to
+    the best of BASE_URL and MIRRORS and fail over to the next one on
+    connection errors and server errors, or are hedged when HEDGE is set.
+    Client errors from mirrors (a thread not there yet, a blocked one) are
+    checked with the next mirror too and a mirror which turns out to lag
+    is marked down. Reads which stall for MIRROR_READ_TIMEOUT fail over
+    without retrying. Posting and captcha always use BASE_URL.
+
+    :rtype: urllib3.response.HTTPResponse
+    """
+    base = site_of(url)
+    if not MIRRORS or base is None or method != 'GET' or endpoint(url) in ('captcha', 'posting'):
+        return send(method, url, priority, **kwargs)
+    path = url[len(base):]
+    kwargs.setdefault('timeout', Timeout(connect=MIRROR_CONNECT_TIMEOUT, read=MIRROR_READ_TIMEOUT))
+    kwargs.setdefault('retries', Retry(connect=0, read=0, redirect=3))
+    bases = mirror_order()
+    fallback = failure = None
+    if HEDGE:
+        secondary = next((b for b in bases[1:] if not mirror_down(b)), None)
+        if secondary is not None:
+            resp, fallback, failure = hedged(method, bases[0], secondary, path, priority, **kwargs)
+            if resp is not None:
+                return resp
+            bases = [b for b in bases if b not in (bases[0], secondary)]
+    for i, base in enumerate(bases):
+        try:
+            resp = send(method, base + path, priority, RATE_RETRIES if i + 1 == len(bases) else 0, **kwargs)
+        except HTTPError as e:
+            failure = e
+        else:
+            if authoritative(base, resp):
+                if fallback is not None and resp.status < 400:
+                    mirror_report(fallback[0] + path, None)
+                return resp
+            if resp.status >= 500:
+                failure = resp
+            elif fallback is None:
+                fallback = (base, resp)
+        if metrics is not None:
+            metrics.inc('sosuch_failover_total', mirror=base)
+    if fallback is not None:
+        return fallback[1]
+    if isinstance(failure, HTTPError):
+        raise failure
+    return failure
+
+class Solvers(object):
+    """
+    Pool of long-lived captcha solvers started from CAPTCHA_SOLVER. Each
+    solver reads requests from stdin, a line "<captcha id> <image size>"
+    followed by the image bytes, and answers each with one line holding
+    the solution, an empty line if it cannot solve the captcha.
+    """
+    def __init__(self, command, size, cwd=None):
+        self.command = command
+        self.size = size
+        self.cwd = cwd
+        self.started = 0
+        self.idle = []
+        self.cond = threading.Condition()
+        atexit.register(self.close)
+
+    def take(self):
+        with self.cond:
+            while not self.idle and self.started >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return Popen(shlex.split(self.command), stdin=PIPE, stdout=PIPE, bufsize=0, cwd=self.cwd)
+        except OSError:
+            self.drop(None)
+            raise
+
+    def release(self, proc):
+        with self.cond:
+            self.idle.append(proc)
+            self.cond.notify()
+
+    def drop(self, proc):
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+        with self.cond:
+            self.started -= 1
+            self.cond.notify()
+
+    def answer(self, proc):
+        """
+        :returns: One answer line, None when the solver did not give one
+        within CAPTCHA_SOLVER_TIMEOUT or gave more
+        :rtype: bytes
+        """
+        deadline = time.time() + CAPTCHA_SOLVER_TIMEOUT
+        data = b''
+        while not data.endswith(b'\n'):
+            left = deadline - time.time()
+            if left <= 0 or not select.select([proc.stdout], [], [], left)[0]:
+                return None
+            chunk = os.read(proc.stdout.fileno(), 4096)
+            if not chunk:
+                return None
+            data += chunk
+        if data.count(b'\n') > 1:
+            return None
+        return data
+
+    def solve(self, captcha_id, img):
+        """
+        :returns: Solution, None if the solver could not solve the captcha.
+        A solver which died, timed out or broke the protocol is stopped
+        and a new one is started on next use.
+        :rtype: str
+        """
+        proc = self.take()
+        try:
+            proc.stdin.write(('%s %d\n' % (captcha_id, len(img))).encode('utf-8'))
+            proc.stdin.write(img)
+            proc.stdin.flush()
+            line = self.answer(proc)
+        except OSError:
+            line = None
+        if line is None:
+            self.drop(proc)
+            return None
+        self.release(proc)
+        return line.decode('utf-8').strip() or None
+
+    def close(self):
+        with self.cond:
+            while self.idle:
+                proc = self.idle.pop()
+                proc.stdin.close()
+                try:
+                    proc.wait(1)
+                except TimeoutExpired:
+                    proc.kill()
+                self.started -= 1
+
+def solver_pool(command, size, cwd=None):
+    """
+    :returns: Solver pool for the command, replacing the one started for
+    another command
+    :rtype: Solvers
+    """
+    global solvers
+    with solvers_lock:
+        if solvers is None or (solvers.command, solvers.size, solvers.cwd) != (command, size, cwd):
+            if solvers is not None:
+                solvers.close()
+            solvers = Solvers(command, size, cwd)
+        return solvers
+
+def daemon_solve(captcha_id, img):
+    """
+    Solves the captcha with the solvers kept by the daemon (see serve), so
+    they are started once for all posting commands. The daemon solves
+    captchas in parallel with each other and with forwarded commands.
+
+    :returns: Solution, '' when the solvers failed or did not answer in
+    time, None without a daemon
+    :rtype: str
+    """
+    if hasattr(sys.stdout, 'page') or not os.path.exists(DAEMON_SOCKET):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(DAEMON_WAIT)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        return None
+    try:
+        # waiting for a free solver and for its answer
+        sock.settimeout(2 * CAPTCHA_SOLVER_TIMEOUT)
+        sock.sendall(dumps({'solve': captcha_id, 'solver': CAPTCHA_SOLVER, 'solvers': CAPTCHA_SOLVERS,
+                            'cwd': os.getcwd(), 'size': len(img)}).encode('utf-8') + b'\n' + img)
+        kind, data = recv_frame(sock.makefile('rb'))
+    except OSError:
+        return ''
+    finally:
+        sock.close()
+    if kind != b'c':
+        return ''
+    return data.decode('utf-8')
+
+def solve_captcha(captcha_id, img):
+    """
+    Solves the captcha with solvers kept by the daemon or, without one,
+    started by this process if CAPTCHA_SOLVER is set. Runs
+    CAPTCHA_RESOLVE_SCRIPT on a temporary file otherwise or when the
+    solvers fail.
+
+    :rtype: str
+    """
+    if CAPTCHA_SOLVER:
+        solution = daemon_solve(captcha_id, img)
+        if solution is None:
+            try:
+                solution = solver_pool(CAPTCHA_SOLVER, CAPTCHA_SOLVERS).solve(captcha_id, img)
+            except OSError:
+                solution = None
+        if solution:
+            return solution
+    fd, fn = mkstemp(suffix='.png')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(img)
+        return check_output([CAPTCHA_RESOLVE_SCRIPT, captcha_id, fn]).decode('utf-8').strip()
+    finally:
+        os.remove(fn)
+
+def resolve_captcha():
+    CAPTCHA_URL = '%s/makaba/captcha.fcgi' % BASE_URL
+    resp = request('GET', CAPTCHA_URL, fields={'type': '2chaptcha', 'action': 'thread'})
+    if resp.status == 200:
+        data = resp.data.decode('utf-8')
+        _, captcha_id = data.split('\n')
+        CAPTCHA_IMG_URL = '%s/makaba/captcha.fcgi' % BASE_URL
+        resp = request('GET', CAPTCHA_IMG_URL, fields={'type': '2chaptcha', 'action': 'image', 'id': captcha_id})
+        return (solve_captcha(captcha_id, resp.data), captcha_id)
+    return None
+
+def mirror_path(board, *parts):
+    return os.path.join(MIRROR_DIR, board, *parts)
+
+def write_file(fn, data):
+    """
+    Atomically replaces file contents, creating directories as needed
+    """
+    dn = os.path.dirname(fn)
+    if dn:
+        os.makedirs(dn, exist_ok=True)
+    fd, tmp = mkstemp(dir=dn or '.', prefix='.sosuch')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, fn)
+
+def cache_get(key):
+    with json_cache_lock:
+        if key in json_cache:
+            json_cache.move_to_end(key)
+            return json_cache[key]
+    return None
+
+def cache_put(key, value):
+    with json_cache_lock:
+        json_cache[key] = value
+        json_cache.move_to_end(key)
+        if len(json_cache) > JSON_CACHE_SIZE:
+            json_cache.popitem(last=False)
+
+def get_json(board, path, offline=False, priority=PRIORITY_INTERACTIVE):
+    """
+    Fetches board JSON (catalog.json, res/N.json) from the site or, when
+    offline, from the mirror where threads fallen off the board are looked
+    up in the archive. Decoded data is kept in a small LRU cache, checked
+    against file mtime or revalidated with conditional requests, which pays
+    off in the daemon.
+
+    :returns: (HTTP-like status, decoded data or None)
+    :rtype: tuple
+    """
+    if offline:
+        fns = [mirror_path(board, path)]
+        if path.startswith('res/'):
+            fns.append(mirror_path(board, 'archive', path[4:]))
+        for fn in fns:
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            cached = cache_get(fn)
+            if cached is not None and cached[0] == stamp:
+                if metrics is not None:
+                    metrics.inc('sosuch_json_cache_total', result='hit')
+                return 200, cached[1]
+            if metrics is not None:
+                metrics.inc('sosuch_json_cache_total', result='miss')
+            with open(fn, 'rb') as f:
+                data = loads(f.read().decode('utf-8'))
+            cache_put(fn, (stamp, data))
+            return 200, data
+        return 404, None
+    url = '%s/%s/%s' % (BASE_URL, board, path)
+    cached = cache_get(url)
+    resp = request('GET', url, priority, headers=cached[0] if cached else None)
+    if metrics is not None:
+        metrics.inc('sosuch_json_cache_total', result='revalidated' if resp.status == 304 and cached else 'miss')
+    if resp.status == 304 and cached:
+        return 200, cached[1]
+    if resp.status == 200:
+        data = loads(resp.data.decode('utf-8'))
+        headers = {}
+        if 'Last-Modified' in resp.headers:
+            headers['If-Modified-Since'] = resp.headers['Last-Modified']
+        if 'ETag' in resp.headers:
+            headers['If-None-Match'] = resp.headers['ETag']
+        if headers:
+            cache_put(url, (headers, data))
+        return resp.status, data
+    return resp.status, None
+
+def sync_thread(board, num):
+    """
+    :returns: Size of the downloaded thread, None on error
+    :rtype: int
+    """
+    try:
+        resp = request('GET', '%s/%s/res/%s.json' % (BASE_URL, board, num), PRIORITY_BACKGROUND)
+    except HTTPError:
+        return None
+    if resp.status != 200:
+        return None
+    write_file(mirror_path(board, 'res', '%s.json' % num), resp.data)
+    return len(resp.data)
+
+def sync(board):
+    """
+    Brings the board mirror up to date. Only threads whose posts_count or
+    lasthit changed since the previous sync are downloaded, threads which
+    fell off the board are moved to the archive.
+
+    :returns: Sync stats, also stored in the mirror
+    :rtype: dict
+    """
+    started = time.time()
+    resp = request('GET', '%s/%s/catalog.json' % (BASE_URL, board), PRIORITY_BACKGROUND)
+    if resp.status != 200:
+        print("Error %d" % resp.status)
+        return None
+    catalog = loads(resp.data.decode('utf-8'))
+    state_fn = mirror_path(board, 'sync.json')
+    state = {'threads': {}}
+    if os.path.exists(state_fn):
+        with open(state_fn, 'rt') as f:
+            state = loads(f.read())
+    known = state['threads']
+
+    fresh = {}
+    changed = []
+    for t in catalog["threads"]:
+        num = str(t["num"])
+        fresh[num] = [t["posts_count"], t.get("lasthit")]
+        if known.get(num) != fresh[num] or \
+                not os.path.exists(mirror_path(board, 'res', num + '.json')):
+            changed.append(num)
+
+    archived = 0
+    for num in set(known) - set(fresh):
+        fn = mirror_path(board, 'res', num + '.json')
+        if os.path.exists(fn):
+            os.makedirs(mirror_path(board, 'archive'), exist_ok=True)
+            os.replace(fn, mirror_path(board, 'archive', num + '.json'))
+            archived += 1
+
+    failed = 0
+    size = len(resp.data)
+    with ThreadPoolExecutor(SYNC_WORKERS) as pool:
+        for num, n in zip(changed, pool.map(lambda num: sync_thread(board, num), changed)):
+            if n is None:
+                # retry on next sync
+                failed += 1
+                if num in known:
+                    fresh[num] = known[num]
+                else:
+                    del fresh[num]
+            else:
+                size += n
+    write_file(mirror_path(board, 'catalog.json'), resp.data)
+    update_index(board, catalog["threads"])
+
+    stats = {'time': int(started),
+             'threads': len(catalog["threads"]),
+             'fetched': len(changed) - failed,
+             'unchanged': len(catalog["threads"]) - len(changed),
+             'archived': archived,
+             'failed': failed,
+             'bytes': size,
+             'seconds': round(time.time() - started, 3)}
+    write_file(state_fn, dumps({'threads': fresh, 'stats': stats}).encode('utf-8'))
+    return stats
+
+def update_index(board, threads):
+    """
+    Writes the completion index of the board: one "num<TAB>subject" line
+    per thread, read by the completion scripts (see completion_script).
+    """
+    lines = []
+    for t in threads:
+        title = t.get("subject") or t.get("comment") or ""
+        title = RE_WHITESPACE.sub(' ', html_unescape(RE_TAG.sub(' ', title))).strip()
+        lines.append("%s\t%s\n" % (t["num"], title[:COMPLETE_SUBJECT_LEN]))
+    try:
+        write_file(os.path.join(COMPLETE_DIR, board), ''.join(lines).encode('utf-8'))
+    except OSError:
+        pass
+
+def completion_script(shell, prog):
+    """
+    :returns: Completion script for the shell, candidates come from the
+    completion index and stale indexes are refreshed in the background
+    :rtype: str
+    """
+    script = COMPLETE_SCRIPTS[shell]
+    return script.replace('@PROG@', prog).replace('@FUNC@', '_' + re.sub(r'\W', '_', prog)) \
+                 .replace('@MAX_AGE@', str(COMPLETE_MAX_AGE))
+
+def threads(board, fmt='text', text=False, offline=False, quotes=False):
+    status, data = get_json(board, 'catalog.json', offline)
+    if status == 200:
+        threads = data["threads"]
+        update_index(board, threads)
+        quoted = resolve_quotes(quoted_refs(threads, board), offline) if quotes else None
+        page((render_post(t, board, fmt, text, summary=True, quotes=quoted) for t in threads), fmt)
+    else:
+        print("Error %d" % status, file=sys.stderr if fmt == 'jsonl' else sys.stdout)
+    
+def format_lite(t, board, fmt='text'):
+    """
+    :returns: One line for a thread from threads.json (or the catalog),
+    subject only unescaped, no HTML conversion
+    :rtype: str
+    """
+    num = int(t["num"])
+    subj = RE_WHITESPACE.sub(' ', html_unescape(RE_TAG.sub('', t.get("subject") or ""))).strip()
+    if fmt == 'jsonl':
+        rec = {'board': board, 'num': num, 'posts_count': t.get("posts_count"), 'subject': subj}
+        if "lasthit" in t:
+            rec['lasthit'] = t["lasthit"]
+        return dumps(rec, ensure_ascii=False, separators=(',', ':')) + "\n"
+    if fmt == 'plain':
+        return ">>%d %d %s\n" % (num, t.get("posts_count", 0), subj)
+    return "%s %s %s\n" % (STYLE_NUM + ">>%d" % num + STYLE_RESET,
+                           STYLE_SUMMARY + "%4d" % t.get("posts_count", 0) + STYLE_RESET,
+                           STYLE_SUBJ + subj + STYLE_RESET)
+
+def threads_lite(board, fmt='text', offline=False):
+    """
+    Lists threads from the small threads.json index, or from the mirrored
+    catalog when offline.
+    """
+    status, data = get_json(board, 'catalog.json' if offline else 'threads.json', offline)
+    if status == 200:
+        threads = data["threads"]
+        update_index(board, threads)
+        page((format_lite(t, board, fmt) for t in threads), fmt)
+    else:
+        print("Error %d" % status, file=sys.stderr if fmt == 'jsonl' else sys.stdout)
+
+def posts(board, thread, fmt='text', text=False, offline=False, quotes=False):
+    status, data = get_json(board, 'res/%s.json' % thread, offline)
+    if status == 200:
+        posts = data["threads"][0]["posts"]
+        quoted = resolve_quotes(quoted_refs(posts, board, thread), offline) if quotes else None
+        page((render_post(p, board, fmt, text, quotes=quoted) for p in posts), fmt)
+    else:
+        print("Error %d" % (status), file=sys.stderr if fmt == 'jsonl' else sys.stdout)
+
+def thread_columns(board, fn):
+    """
+    :returns: Rows of a mirrored thread as (nums, timestamps, files counts,
+    reply sources, reply targets)
+    :rtype: tuple
+    """
+    with open(fn, 'rb') as f:
+        data = loads(f.read().decode('utf-8'))
+    nums, stamps, files, src, dst = [], [], [], [], []
+    for p in data['threads'][0]['posts']:
+        nums.append(p['num'])
+        stamps.append(p['timestamp'])
+        files.append(len(p.get('files') or []))
+        for b, t, n in RE_REPLY_HREF.findall(p['comment']):
+            if b == board:
+                src.append(p['num'])
+                dst.append(int(n))
+    return nums, stamps, files, src, dst
+
+def mirror_threads(board):
+    """
+    :returns: Mirrored and archived threads of the board as
+    {num: (path, mtime_ns, size)}
+    :rtype: dict
+    """
+    sources = {}
+    for d in ('res', 'archive'):
+        path = mirror_path(board, d)
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            if entry.name.endswith('.json') and entry.name[:-5].isdigit():
+                st = entry.stat()
+                # archived threads keep their mtime, so moving one is not a change
+                sources[int(entry.name[:-5])] = (entry.path, st.st_mtime_ns, st.st_size)
+    return sources
+
+def load_columns(board):
+    """
+    Loads all mirrored and archived posts of the board into columnar
+    arrays. Columns are cached in the mirror and only threads whose files
+    changed since the last run are parsed again.
+
+    :returns: Arrays keyed by column name
+    :rtype: dict
+    """
+    sources = mirror_threads(board)
+    cache_fn = mirror_path(board, 'stats.npz')
+    cols = dict((k, np.zeros(0, np.int64)) for k in STATS_COLUMNS)
+    cached = {}
+    if os.path.exists(cache_fn):
+        with np.load(cache_fn) as f:
+            if all(k in f for k in STATS_COLUMNS + ['sources']):
+                cols = dict((k, f[k]) for k in STATS_COLUMNS)
+                cached = dict((int(t), (int(m), int(s))) for t, m, s in f['sources'])
+    unchanged = set(t for t, v in cached.items() if t in sources and sources[t][1:] == v)
+    valid = np.array(sorted(unchanged), np.int64)
+    keep = np.isin(cols['thread'], valid)
+    keep_edges = np.isin(cols['reply_thread'], valid)
+    changed = [t for t in sources if t not in unchanged]
+
+    if changed:
+        fns = [sources[t][0] for t in changed]
+        if len(fns) > STATS_PARSE_CHUNK and 'fork' in get_all_start_methods():
+            with ProcessPoolExecutor(mp_context=get_context('fork')) as pool:
+                rows = list(pool.map(thread_columns, repeat(board), fns, chunksize=STATS_PARSE_CHUNK))
+        else:
+            rows = [thread_columns(board, fn) for fn in fns]
+        new = {'num': [], 'thread': [], 'timestamp': [], 'files': [],
+               'reply_src': [], 'reply_dst': [], 'reply_thread': []}
+        for t, (nums, stamps, files, src, dst) in zip(changed, rows):
+            new['num'].extend(nums)
+            new['thread'].extend([t] * len(nums))
+            new['timestamp'].extend(stamps)
+            new['files'].extend(files)
+            new['reply_src'].extend(src)
+            new['reply_dst'].extend(dst)
+            new['reply_thread'].extend([t] * len(src))
+        for k in STATS_COLUMNS:
+            mask = keep_edges if k.startswith('reply_') else keep
+            cols[k] = np.concatenate([cols[k][mask], np.array(new[k], np.int64)])
+    elif not keep.all() or not keep_edges.all():
+        for k in STATS_COLUMNS:
+            cols[k] = cols[k][keep_edges if k.startswith('reply_') else keep]
+
+    if changed or len(valid) != len(cached):
+        src_rows = np.array([(t, v[1], v[2]) for t, v in sources.items()], np.int64).reshape(-1, 3)
+        fd, tmp = mkstemp(dir=mirror_path(board), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, sources=src_rows, **cols)
+        os.replace(tmp, cache_fn)
+    return cols
+
+def describe(a):
+    if len(a) == 0:
+        return {'min': 0, 'median': 0, 'mean': 0, 'p90': 0, 'max': 0}
+    return {'min': float(a.min()), 'median': float(np.median(a)), 'mean': float(a.mean()),
+            'p90': float(np.percentile(a, 90)), 'max': float(a.max())}
+
+def board_stats(cols):
+    """
+    :returns: Posting statistics computed from board columns
+    :rtype: dict
+    """
+    num, thread, ts, files = cols['num'], cols['thread'], cols['timestamp'], cols['files']
+    res = {'posts': int(len(num)), 'threads': 0, 'first': None, 'last': None}
+    if len(num) == 0:
+        return res
+    order = np.argsort(thread, kind='stable')
+    t_sorted = thread[order]
+    starts = np.flatnonzero(np.r_[True, t_sorted[1:] != t_sorted[:-1]])
+    ts_sorted = ts[order]
+    lifetimes = (np.maximum.reduceat(ts_sorted, starts) - np.minimum.reduceat(ts_sorted, starts)) / 3600.0
+    thread_posts = np.diff(np.r_[starts, len(t_sorted)])
+    span = max((ts.max() - ts.min()) / 3600.0, 1.0)
+    hourly = np.bincount((ts // 3600) % 24, minlength=24)
+    res.update({'threads': int(len(starts)),
+                'first': int(ts.min()),
+                'last': int(ts.max()),
+                'posts_per_hour': round(len(num) / span, 2),
+                'posts_by_hour_utc': hourly.tolist(),
+                'thread_lifetime_hours': describe(lifetimes),
+                'thread_posts': describe(thread_posts),
+                'files': int(files.sum()),
+                'posts_with_files': round(float((files > 0).mean()), 4)})
+
+    # reply edges as indices into the post columns; a post may only reply to an earlier one
+    by_num = np.argsort(num)
+    src = np.searchsorted(num, cols['reply_src'], sorter=by_num)
+    dst = np.searchsorted(num, cols['reply_dst'], sorter=by_num)
+    src = by_num[np.minimum(src, len(num) - 1)]
+    dst = by_num[np.minimum(dst, len(num) - 1)]
+    ok = (num[src] == cols['reply_src']) & (num[dst] == cols['reply_dst']) & (num[dst] < num[src])
+    src, dst = src[ok], dst[ok]
+    replies = np.bincount(dst, minlength=len(num))
+    depth = np.zeros(len(num), np.int64)
+    while len(src):
+        new = depth.copy()
+        np.maximum.at(new, src, depth[dst] + 1)
+        if np.array_equal(new, depth):
+            break
+        depth = new
+    top = np.argsort(-replies, kind='stable')[:STATS_TOP]
+    res.update({'replies': int(len(src)),
+                'posts_with_replies': round(float((replies > 0).mean()), 4),
+                'replies_per_post': describe(replies),
+                'most_replied': [[int(num[i]), int(thread[i]), int(replies[i])] for i in top if replies[i]],
+                'reply_depth': describe(depth),
+                'reply_depth_counts': np.bincount(depth).tolist()})
+    return res
+
+def format_stats(board, s):
+    lines = ["/%s/: %d posts in %d threads" % (board, s['posts'], s['threads'])]
+    if not s['posts']:
+        return "\n".join(lines) + "\n"
+    fmt_time = lambda t: time.strftime('%Y-%m-%d %H:%M', time.gmtime(t))
+    lines.append("from %s to %s UTC, %.2f posts per hour" % (fmt_time(s['first']), fmt_time(s['last']), s['posts_per_hour']))
+    lines.append("%d files, %.1f%% of posts with files, %d replies, %.1f%% of posts replied to" %
+                 (s['files'], s['posts_with_files'] * 100, s['replies'], s['posts_with_replies'] * 100))
+    lines.append("")
+    lines.append("%-22s %10s %10s %10s %10s %10s" % ('', 'min', 'median', 'mean', 'p90', 'max'))
+    for title, key in (('thread lifetime, h', 'thread_lifetime_hours'), ('posts per thread', 'thread_posts'),
+                       ('replies per post', 'replies_per_post'), ('reply depth', 'reply_depth')):
+        d = s[key]
+        lines.append("%-22s %10.1f %10.1f %10.1f %10.1f %10.1f" % (title, d['min'], d['median'], d['mean'], d['p90'], d['max']))
+    lines.append("")
+    peak = max(s['posts_by_hour_utc']) or 1
+    lines.append("posts by hour, UTC")
+    for h, n in enumerate(s['posts_by_hour_utc']):
+        lines.append("%02d %10d %s" % (h, n, '#' * int(round(40.0 * n / peak))))
+    lines.append("")
+    lines.append("reply depth")
+    for d, n in enumerate(s['reply_depth_counts']):
+        lines.append("%2d %10d" % (d, n))
+    if s['most_replied']:
+        lines.append("")
+        lines.append("most replied")
+        for n, t, r in s['most_replied']:
+            lines.append("%s %10d" % (STYLE_NUM + ">>%d" % n + STYLE_RESET + " in %d" % t, r))
+    return "\n".join(lines) + "\n"
+
+def stats(board, fmt='text'):
+    """
+    Prints posting statistics of the mirrored board, see sync.
+
+    :rtype: bool
+    """
+    if np is None:
+        print("Board statistics require numpy")
+        return False
+    s = board_stats(load_columns(board))
+    if fmt == 'jsonl':
+        print(dumps(s, ensure_ascii=False))
+    elif fmt == 'plain':
+        print(RE_ANSI.sub('', format_stats(board, s)), end='')
+    else:
+        print(format_stats(board, s), end='')
+    return True
+
+def grep_thread(board, num, pattern, offline=False):
+    """
+    :returns: (thread, [(post num, text, match)]) for posts whose comment
+    text, tags stripped and entities unescaped, matches the pattern, the
+    HTTP status or the error instead of the list when the thread failed
+    :rtype: tuple
+    """
+    try:
+        status, data = get_json(board, 'res/%s.json' % num, offline)
+    except HTTPError as e:
+        return num, e
+    if status != 200:
+        return num, status
+    found = []
+    for p in data["threads"][0]["posts"]:
+        text = RE_WHITESPACE.sub(' ', html_unescape(RE_TAG.sub(' ', p["comment"])))
+        m = pattern.search(text)
+        if m:
+            found.append((p["num"], text, m))
+    return num, found
+
+def format_match(board, thread, num, text, m, fmt='text'):
+    start = max(0, m.start() - GREP_CONTEXT)
+    end = min(len(text), m.end() + GREP_CONTEXT)
+    before, match, after = text[start:m.start()], text[m.start():m.end()], text[m.end():end]
+    before = ('...' if start else '') + before.lstrip()
+    after = after.rstrip() + ('...' if end < len(text) else '')
+    if fmt == 'jsonl':
+        return dumps({'board': board, 'thread': int(thread), 'num': num, 'snippet': before + match + after},
+                     ensure_ascii=False, separators=(',', ':')) + "\n"
+    if fmt == 'plain':
+        return "/%s/%s >>%s %s%s%s\n" % (board, thread, num, before, match, after)
+    return "%s %s %s%s%s\n" % (STYLE_SUMMARY + "/%s/%s" % (board, thread) + STYLE_RESET,
+                               STYLE_NUM + ">>%s" % num + STYLE_RESET,
+                               before, Style.BRIGHT + Fore.RED + match + STYLE_RESET, after)
+
+def grep(board, pattern, fmt='text', offline=False, max_matches=0):
+    """
+    Searches all threads of the board, fetched concurrently, printing
+    matches as they are found. Once max_matches are found no more threads
+    are requested.
+
+    :returns: Number of matches
+    :rtype: int
+    """
+    status, data = get_json(board, 'catalog.json', offline)
+    if status != 200:
+        print("Error %d" % status, file=sys.stderr if fmt == 'jsonl' else sys.stdout)
+        return 0
+    nums = iter([t["num"] for t in data["threads"]])
+    matches = 0
+    with ThreadPoolExecutor(GREP_WORKERS) as pool:
+        running = set(pool.submit(grep_thread, board, num, pattern, offline)
+                      for num in islice(nums, GREP_WORKERS))
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                thread, found = f.result()
+                if not isinstance(found, list):
+                    print("/%s/%s: %s" % (board, thread, 'not found' if found == 404 else found), file=sys.stderr)
+                    found = []
+                for num, text, m in found:
+                    if max_matches and matches >= max_matches:
+                        break
+                    sys.stdout.write(format_match(board, thread, num, text, m, fmt))
+                    matches += 1
+                sys.stdout.flush()
+            if max_matches and matches >= max_matches:
+                for f in running:
+                    f.cancel()
+                break
+            running |= set(pool.submit(grep_thread, board, num, pattern, offline)
+                           for num in islice(nums, len(done)))
+    return matches
+
+def archive_refs(p, board, local):
+    """
+    :returns: Reply links of the post as (thread, num, local) where local
+    tells whether the thread has a page in the archive
+    :rtype: list
+    """
+    return [(int(t), int(n), int(t) in local) for b, t, n in RE_REPLY_HREF.findall(p["comment"]) if b == board]
+
+def post_digest(p, *extra):
+    """
+    :returns: Digest of the post content and anything else its rendering
+    depends on
+    :rtype: str
+    """
+    key = [p.get(k) for k in ARCHIVE_KEYS] + [f.get("path") for f in p.get("files") or []] + list(extra)
+    return md5(dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def archive_file_link(board, f, media):
+    if media:
+        return 'media/' + f["path"]
+    return '%s/%s/%s' % (BASE_URL, board, f["path"])
+
+def render_archive_post(p, board, local, fmt='html', media=False):
+    """
+    :returns: Post as an HTML or Markdown fragment with reply links pointing
+    into archived pages and file links pointing to local media when asked
+    :rtype: str
+    """
+    ext = ARCHIVE_FORMATS[fmt]
+    def ref_link(b, t, n):
+        if b == board and int(t) in local:
+            return '%s.%s#%s' % (t, ext, n)
+        return '%s/%s/res/%s.html#%s' % (BASE_URL, b, t, n)
+    files = p.get("files") or []
+    if fmt == 'html':
+        comment = RE_REPLY_HREF.sub(lambda m: 'href="%s"' % ref_link(*m.groups()), p["comment"])
+        comment = RE_SITE_HREF.sub('href="%s/' % BASE_URL, comment)
+        flags = ''.join(' <span class="flag">[%s]</span>' % k for k in ("banned", "sticky", "closed") if p.get(k) == 1)
+        out = ['<div class="post" id="%s">' % p["num"],
+               '<div class="head"><span class="subject">%s</span> <span class="name">%s</span> %s <a href="#%s">&gt;&gt;%s</a>%s</div>' %
+               (p.get("subject", ""), p.get("name", ""), html_escape(p.get("date", "")), p["num"], p["num"], flags)]
+        for f in files:
+            out.append('<div class="file"><a href="%s">%s</a></div>' %
+                       (html_escape(archive_file_link(board, f, media)), html_escape(f.get("name") or f["path"])))
+        out.append('<blockquote>%s</blockquote></div>\n' % comment)
+        return '\n'.join(out)
+    threads = dict((n, t) for b, t, n in RE_REPLY_HREF.findall(p["comment"]) if b == board)
+    text = html2text(p["comment"], plain=True, width=0).strip().replace('<', '&lt;')
+    text = RE_REPLY_TEXT.sub(lambda m: '[>>%s](%s)' % (m.group(1), ref_link(board, threads[m.group(1)], m.group(1)))
+                             if m.group(1) in threads else m.group(0), text)
+    subj = html2text(p["subject"], plain=True, width=0).strip().replace('<', '&lt;') + ' · ' if p.get("subject") else ''
+    name = html2text(p.get("name", ""), plain=True, width=0).strip().replace('<', '&lt;')
+    out = ['<a id="%s"></a>' % p["num"], '### %s%s · %s · [>>%s](#%s)' %
+           (subj, name, p.get("date", "").replace('<', '&lt;'), p["num"], p["num"]), '']
+    for f in files:
+        out.append('[%s](%s)  ' % ((f.get("name") or f["path"]).replace('<', '&lt;'), archive_file_link(board, f, media)))
+    out.append('')
+    out.append(text)
+    return '\n'.join(out) + '\n\n'
+
+def archive_page(board, title, body, fmt='html'):
+    """
+    :returns: Page with the (plain text) title and the rendered body
+    :rtype: str
+    """
+    if fmt == 'html':
+        return ARCHIVE_HTML % {'title': html_escape(title), 'body': body}
+    return '# %s\n\n%s' % (title.replace('<', '&lt;'), body)
+
+def fetch_media(board, outdir, paths):
+    """
+    Downloads files missing from the archive media directory
+
+    :returns: Number of files downloaded
+    :rtype: int
+    """
+    missing = [p for p in paths if not os.path.exists(os.path.join(outdir, 'media', p))]
+    def fetch(path):
+        try:
+            resp = request('GET', '%s/%s/%s' % (BASE_URL, board, path), PRIORITY_BACKGROUND)
+        except HTTPError:
+            return False
+        if resp.status != 200:
+            return False
+        write_file(os.path.join(outdir, 'media', path), resp.data)
+        return True
+    with ThreadPoolExecutor(SYNC_WORKERS) as pool:
+        return sum(pool.map(fetch, missing))
+
+def archive(board, outdir, fmt='html', nums=None, media=False):
+    """
+    Renders mirrored threads (see sync) into static pages in outdir with an
+    index page listing every archived thread. Threads whose mirror files
+    did not change and whose linked threads neither got nor lost a page
+    are skipped without reading them, rendered posts are cached by content
+    digest and pages are only written when their content changed. Only
+    threads with pages get local links, pages linking to a thread which
+    got its page in a partial run are updated as well.
+
+    :returns: Archive stats
+    :rtype: dict
+    """
+    sources = mirror_threads(board)
+    nums = sorted(int(n) for n in nums) if nums else sorted(sources)
+    ext = ARCHIVE_FORMATS[fmt]
+    state_fn = os.path.join(outdir, '.archive.json')
+    state = {'version': ARCHIVE_VERSION, 'format': fmt, 'media': media, 'threads': {}}
+    if os.path.exists(state_fn):
+        with open(state_fn, 'rt') as f:
+            old = loads(f.read())
+        if all(old.get(k) == state[k] for k in ('version', 'format', 'media')):
+            state = old
+    known = state['threads']
+    # threads with a page once this run is done
+    local = set(n for n in nums if n in sources) | set(int(k) for k in known)
+    # archived pages linking to threads which got or lost a page are redone too
+    chosen = set(nums)
+    nums += sorted(int(k) for k, v in known.items() if int(k) not in chosen and int(k) in sources and
+                   [t for t in v['refs'] if t in local] != v['local_refs'])
+    stats = {'threads': 0, 'unchanged': 0, 'rendered': 0, 'posts': 0, 'written': 0, 'missing': 0, 'media': 0}
+    files = []
+    for num in nums:
+        if num not in sources:
+            print("/%s/%d is not in the mirror" % (board, num), file=sys.stderr)
+            stats['missing'] += 1
+            continue
+        stats['threads'] += 1
+        fn, mtime, size = sources[num]
+        key = str(num)
+        page_fn = os.path.join(outdir, '%d.%s' % (num, ext))
+        entry = known.get(key)
+        if (entry and entry['stamp'] == [mtime, size] and os.path.exists(page_fn) and
+                [t for t in entry['refs'] if t in local] == entry['local_refs']):
+            stats['unchanged'] += 1
+            continue
+        with open(fn, 'rb') as f:
+            posts = loads(f.read().decode('utf-8'))["threads"][0]["posts"]
+        cache_fn = os.path.join(outdir, '.cache', '%d.json' % num)
+        cache = {}
+        if os.path.exists(cache_fn):
+            with open(cache_fn, 'rt') as f:
+                cache = loads(f.read())
+        fragments = OrderedDict()
+        refs = set()
+        for p in posts:
+            links = archive_refs(p, board, local)
+            refs.update(t for t, n, l in links if t != num)
+            h = post_digest(p, links, fmt, media)
+            if h not in cache:
+                cache[h] = render_archive_post(p, board, local, fmt, media)
+                stats['posts'] += 1
+            fragments[h] = cache[h]
+            if media:
+                files.extend(f["path"] for f in p.get("files") or [])
+        subject = html2text(posts[0].get("subject") or '', plain=True, width=0).strip() or '/%s/%d' % (board, num)
+        digest = md5(''.join(fragments.keys()).encode('utf-8')).hexdigest()
+        if not entry or entry['digest'] != digest or not os.path.exists(page_fn):
+            write_file(page_fn, archive_page(board, subject, ''.join(fragments.values()), fmt).encode('utf-8'))
+            write_file(cache_fn, dumps(fragments, ensure_ascii=False).encode('utf-8'))
+            stats['written'] += 1
+        stats['rendered'] += 1
+        refs = sorted(refs)
+        known[key] = {'stamp': [mtime, size], 'refs': refs, 'local_refs': [t for t in refs if t in local], 'digest': digest,
+                      'subject': subject, 'posts': len(posts)}
+
+    if media and files:
+        stats['media'] = fetch_media(board, outdir, files)
+    rows = [(int(k), v) for k, v in known.items()]
+    if fmt == 'html':
+        body = ''.join('<div class="thread"><a href="%d.html">&gt;&gt;%d</a> %s <span class="count">%d</span></div>\n' %
+                       (n, n, html_escape(v['subject']), v['posts']) for n, v in sorted(rows))
+    else:
+        body = ''.join('- [>>%d](%d.md) %s (%d)\n' % (n, n, v['subject'].replace('<', '&lt;'), v['posts']) for n, v in sorted(rows))
+    index = archive_page(board, '/%s/' % board, body, fmt).encode('utf-8')
+    index_fn = os.path.join(outdir, 'index.%s' % ext)
+    old_index = None
+    if os.path.exists(index_fn):
+        with open(index_fn, 'rb') as f:
+            old_index = f.read()
+    if index != old_index:
+        write_file(index_fn, index)
+        stats['written'] += 1
+    write_file(state_fn, dumps(state, ensure_ascii=False).encode('utf-8'))
+    return stats
+
+class Watch(object):
+    """
+    Thread or board catalog followed by watch(), polled with its own
+    interval adapted to the rate of new posts.
+    """
+    def __init__(self, board, thread=None):
+        self.board = board
+        self.thread = thread
+        if thread is None:
+            self.url = '%s/%s/catalog.json' % (BASE_URL, board)
+        else:
+            self.url = '%s/%s/res/%s.json' % (BASE_URL, board, thread)
+        self.headers = {}
+        self.seen = None
+        self.stamps = []
+        self.interval = WATCH_MIN_INTERVAL
+        self.status = None
+        self.dead = False
+
+    def __str__(self):
+        if self.thread is None:
+            return '/%s/catalog' % self.board
+        return '/%s/res/%s' % (self.board, self.thread)
+
+    def poll(self):
+        """
+        Conditionally fetches the thread or catalog. First poll only
+        remembers what is already there. Failed requests and malformed
+        replies only set status, adapt() then backs off.
+
+        :returns: Posts (or catalog threads) which appeared since the
+        previous poll
+        :rtype: list
+        """
+        try:
+            resp = request('GET', self.url, PRIORITY_WATCH, headers=self.headers)
+            self.status = resp.status
+            if resp.status != 200:
+                self.dead = resp.status == 404
+                return []
+            data = loads(resp.data.decode('utf-8'))
+            if self.thread is None:
+                items = data["threads"]
+                nums = set(t["num"] for t in items)
+                new = [t for t in items if self.seen is not None and t["num"] not in self.seen]
+            else:
+                items = data["threads"][0]["posts"]
+                nums = items[-1]["num"]
+                new = [p for p in items if self.seen is not None and p["num"] > self.seen]
+                self.dead = items[0]["closed"] == 1
+            stamps = sorted(p["timestamp"] for p in items)[-WATCH_RATE_WINDOW:]
+        except (HTTPError, ValueError, LookupError, TypeError) as e:
+            self.status = '%s: %s' % (type(e).__name__, e)
+            return []
+        # remember the reply only once it is known to be good
+        if 'Last-Modified' in resp.headers:
+            self.headers['If-Modified-Since'] = resp.headers['Last-Modified']
+        if 'ETag' in resp.headers:
+            self.headers['If-None-Match'] = resp.headers['ETag']
+        self.seen = nums
+        if new or not self.stamps:
+            self.stamps = stamps
+        return new
+
+    def adapt(self, new):
+        """
+        Sets next poll interval to the mean gap between the latest posts
+        when there are new ones, backs off otherwise.
+        """
+        if new and len(self.stamps) > 1:
+            gap = (self.stamps[-1] - self.stamps[0]) / (len(self.stamps) - 1)
+            self.interval = min(max(gap, WATCH_MIN_INTERVAL), WATCH_MAX_INTERVAL)
+        else:
+            self.interval = min(self.interval * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+
+def watch(board, specs, fmt='text', text=False, show=None, refresh=None):
+    """
+    Follows threads and catalogs printing only new posts. Specs are thread
+    numbers on the board, board/number for threads on other boards,
+    'catalog' or board/catalog for new threads, or prepared Watch objects.
+    New posts are passed to show(watch, posts) instead of printing them
+    when it is given. refresh() is called at least every
+    WATCH_MIN_INTERVAL and returns new Watch objects to follow.
+    """
+    watched = []
+    for spec in specs:
+        if isinstance(spec, Watch):
+            watched.append(spec)
+            continue
+        b, _, t = spec.rpartition('/')
+        watched.append(Watch(b.strip('/') or board, None if t == 'catalog' else t))
+    order = count()
+    queue = [(0, next(order), w) for w in watched]
+    with ThreadPoolExecutor(WATCH_WORKERS) as pool:
+        while queue or refresh is not None:
+            if refresh is not None:
+                for w in refresh():
+                    heappush(queue, (0, next(order), w))
+            if metrics is not None:
+                metrics.set('sosuch_watch_targets', len(queue))
+            delay = queue[0][0] - time.time() if queue else WATCH_MIN_INTERVAL
+            if refresh is not None:
+                delay = min(delay, WATCH_MIN_INTERVAL)
+            if delay > 0:
+                time.sleep(delay)
+            due = []
+            while queue and queue[0][0] <= time.time():
+                due.append(heappop(queue)[2])
+            for w, new in zip(due, pool.map(Watch.poll, due)):
+                if show is not None:
+                    show(w, new)
+                else:
+                    if new and fmt != 'jsonl':
+                        print(STYLE_SUMMARY + str(w) + STYLE_RESET if fmt == 'text' else str(w))
+                    for p in new:
+                        show_post(p, w.board, fmt, text)
+                if w.dead:
+                    print("%s is gone: %s" % (w, 'closed' if w.status == 200 else w.status), file=sys.stderr)
+                    continue
+                w.adapt(new)
+                heappush(queue, (time.time() + w.interval, next(order), w))
+
+def load_own():
+    """
+    :returns: Index of own posts: 'posts' as [board, thread, num, time],
+    'threads' with the last checked post and conditional request headers
+    per board/thread, 'gone' for threads which are no longer there
+    :rtype: dict
+    """
+    own = {'posts': [], 'threads': {}, 'gone': []}
+    if os.path.exists(OWN_INDEX):
+        with open(OWN_INDEX, 'rt') as f:
+            own.update(loads(f.read()))
+    return own
+
+def update_own(change):
+    """
+    Applies change(own) to the index of own posts, read and written under
+    a lock so concurrent posting and replies commands do not lose updates
+    """
+    os.makedirs(os.path.dirname(OWN_INDEX) or '.', exist_ok=True)
+    with open(OWN_INDEX + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        own = load_own()
+        change(own)
+        write_file(OWN_INDEX, dumps(own).encode('utf-8'))
+
+def record_own(board, thread, num):
+    update_own(lambda own: own['posts'].append([board, str(thread), int(num), int(time.time())]))
+
+def reply_targets(p, board, mine):
+    """
+    :returns: Own post numbers the post replies to, none for own posts
+    :rtype: list
+    """
+    if p["num"] in mine:
+        return []
+    return sorted(set(int(n) for b, t, n in RE_REPLY_HREF.findall(p["comment"])
+                      if b == board and int(n) in mine))
+
+def show_reply(p, board, targets, fmt='text', text=False):
+    if fmt == 'jsonl':
+        rec = post_record(p, board, text)
+        rec['replies_to'] = targets
+        sys.stdout.write(dumps(rec, ensure_ascii=False, separators=(',', ':')) + "\n")
+    else:
+        line = "reply to %s" % ' '.join('>>%d' % n for n in targets)
+        print(line if fmt == 'plain' else STYLE_SUMMARY + line + STYLE_RESET)
+        sys.stdout.write(render_post(p, board, fmt, text))
+    sys.stdout.flush()
+
+def own_watches(board, own):
+    """
+    :returns: Watch for every live thread with own posts, starting after
+    the last checked post or the first own post in the thread
+    :rtype: list
+    """
+    first = {}
+    for b, t, n, _ in own['posts']:
+        key = '%s/%s' % (b, t)
+        if b == board and key not in own['gone']:
+            first[t] = min(first.get(t, n), n)
+    watches = []
+    for t in sorted(first):
+        w = Watch(board, t)
+        state = own['threads'].get('%s/%s' % (board, t), {})
+        w.seen = state.get('seen', first[t])
+        w.headers = state.get('headers', {})
+        watches.append(w)
+    return watches
+
+def replies(board, fmt='text', text=False, follow=False):
+    """
+    Shows new replies to own posts on the board. Threads with own posts are
+    fetched conditionally and only posts after the last check are scanned,
+    each checked against the set of own post numbers. When following, posts
+    recorded meanwhile are picked up from the index.
+
+    :returns: Number of replies found
+    :rtype: int
+    """
+    own = load_own()
+    mine = set(n for b, t, n, _ in own['posts'] if b == board)
+    watches = own_watches(board, own)
+    if follow:
+        followed = set(w.thread for w in watches)
+        stamp = [os.path.getmtime(OWN_INDEX) if os.path.exists(OWN_INDEX) else None]
+
+        def show(w, new):
+            for p in new:
+                targets = reply_targets(p, board, mine)
+                if targets:
+                    show_reply(p, board, targets, fmt, text)
+
+        def refresh():
+            if not os.path.exists(OWN_INDEX) or os.path.getmtime(OWN_INDEX) == stamp[0]:
+                return []
+            stamp[0] = os.path.getmtime(OWN_INDEX)
+            own = load_own()
+            mine.update(n for b, t, n, _ in own['posts'] if b == board)
+            added = [w for w in own_watches(board, own) if w.thread not in followed]
+            followed.update(w.thread for w in added)
+            return added
+
+        watch(board, watches, fmt, text, show=show, refresh=refresh)
+        return 0
+    states = {}
+    gone = []
+    found = 0
+    with ThreadPoolExecutor(WATCH_WORKERS) as pool:
+        for w, new in zip(watches, pool.map(Watch.poll, watches)):
+            key = '%s/%s' % (board, w.thread)
+            for p in new:
+                targets = reply_targets(p, board, mine)
+                if targets:
+                    show_reply(p, board, targets, fmt, text)
+                    found += 1
+            if w.dead:
+                gone.append(key)
+            elif w.status in (200, 304):
+                states[key] = {'seen': w.seen, 'headers': w.headers}
+            else:
+                print("%s: %s" % (w, w.status), file=sys.stderr)
+
+    def change(own):
+        own['threads'].update(states)
+        for key in gone:
+            own['gone'].append(key)
+            own['threads'].pop(key, None)
+    update_own(change)
+    return found
+
+def snapshot_path(board, thread):
+    return os.path.join(SNAPSHOT_DIR, board, '%s.json' % thread)
+
+def snapshot_digests(posts):
+    """
+    :returns: Short content digest of every post by post number
+    :rtype: dict
+    """
+    digests = {}
+    for p in posts:
+        key = [p.get(k) for k in SNAPSHOT_KEYS] + [f.get("md5") for f in p.get("files") or []]
+        digests[str(p["num"])] = md5(dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()[:SNAPSHOT_DIGEST_SIZE]
+    return digests
+
+def diff_thread(board, thread, offline=False):
+    """
+    Compares the thread with its previous snapshot and stores the new one.
+    The first snapshot of a thread only records it, the snapshot of a
+    thread which is gone is removed.
+
+    :returns: (thread, status, posts by post number, deleted, edited, new)
+    with post numbers as strings, change sets are None for the first
+    snapshot, status is None when the request failed
+    :rtype: tuple
+    """
+    fn = snapshot_path(board, thread)
+    old = None
+    if os.path.exists(fn):
+        with open(fn, 'rt') as f:
+            old = loads(f.read())
+    try:
+        status, data = get_json(board, 'res/%s.json' % thread, offline)
+    except HTTPError:
+        status = None
+    if status != 200:
+        if status == 404 and old is not None:
+            os.remove(fn)
+        return thread, status, {}, set(), set(), set()
+    posts = dict((str(p["num"]), p) for p in data["threads"][0]["posts"])
+    new = snapshot_digests(posts.values())
+    if old == new:
+        return thread, status, posts, set(), set(), set()
+    write_file(fn, dumps(new, separators=(',', ':')).encode('utf-8'))
+    if old is None:
+        return thread, status, posts, None, None, None
+    kept = old.keys() & new.keys()
+    return (thread, status, posts, old.keys() - kept,
+            set(n for n in kept if old[n] != new[n]), new.keys() - kept)
+
+def show_change(board, thread, num, change, p=None, fmt='text', text=False):
+    if fmt == 'jsonl':
+        rec = post_record(p, board, text) if p is not None else {'board': board, 'num': int(num)}
+        rec['thread'] = int(thread)
+        rec['change'] = change
+        sys.stdout.write(dumps(rec, ensure_ascii=False, separators=(',', ':')) + "\n")
+        return
+    line = "/%s/%s %s >>%s" % (board, thread, change, num)
+    print(line if fmt == 'plain' else STYLE_SUMMARY + line + STYLE_RESET)
+    if p is not None:
+        sys.stdout.write(render_post(p, board, fmt, text))
+
+def diff(board, threads=None, fmt='text', text=False, offline=False):
+    """
+    Reports posts deleted, edited and added since the previous run for the
+    given threads or all threads in the catalog. Only post numbers and
+    short content digests are kept between runs.
+
+    :returns: Counts of 'threads', 'recorded' (first snapshots), 'gone',
+    'failed', 'deleted', 'edited' and 'new', None if the catalog failed
+    :rtype: dict
+    """
+    if not threads:
+        status, data = get_json(board, 'catalog.json', offline)
+        if status != 200:
+            print("Error %d" % status, file=sys.stderr)
+            return None
+        threads = [str(t["num"]) for t in data["threads"]]
+    res = dict.fromkeys(['threads', 'recorded', 'gone', 'failed', 'deleted', 'edited', 'new'], 0)
+    with ThreadPoolExecutor(DIFF_WORKERS) as pool:
+        for thread, status, posts, deleted, edited, new in pool.map(lambda t: diff_thread(board, t, offline), threads):
+            res['threads'] += 1
+            if status == 404:
+                res['gone'] += 1
+                print("/%s/%s: gone" % (board, thread), file=sys.stderr)
+                continue
+            if status != 200:
+                res['failed'] += 1
+                print("/%s/%s: %s" % (board, thread, 'error %d' % status if status else 'request failed'), file=sys.stderr)
+                continue
+            if deleted is None:
+                res['recorded'] += 1
+                continue
+            for num in sorted(deleted, key=int):
+                show_change(board, thread, num, 'deleted', None, fmt, text)
+            for num, p in posts.items():
+                if num in edited:
+                    show_change(board, thread, num, 'edited', p, fmt, text)
+                elif num in new:
+                    show_change(board, thread, num, 'new', p, fmt, text)
+            res['deleted'] += len(deleted)
+            res['edited'] += len(edited)
+            res['new'] += len(new)
+            sys.stdout.flush()
+    return res
+
+def compressed_writer(f, compression):
+    """
+    :returns: Writer appending one complete gzip member or zstd frame to f
+    once closed
+    """
+    if compression == 'zstd':
+        if zstd is None:
+            raise RuntimeError('zstd compression requires the zstandard module')
+        return zstd.ZstdCompressor().stream_writer(f, closefd=False)
+    return GzipFile(fileobj=f, mode='wb')
+
+def export(board, fn, compression='gzip', offline=False):
+    """
+    Streams all threads of the board into compressed JSONL, one post per
+    record with both raw and converted comment. Every thread is a separate
+    compressed member and FILE.progress records the file size after each
+    one, so an interrupted export continues from the last complete thread.
+
+    :returns: (threads exported, posts exported, threads failed)
+    :rtype: tuple
+    """
+    progress_fn = fn + '.progress'
+    done = []
+    offset = 0
+    if os.path.exists(progress_fn):
+        with open(progress_fn, 'rt') as f:
+            for l in f:
+                # the last line may be cut short by an interrupted run
+                fields = l.split()
+                if not l.endswith('\n') or len(fields) != 2 or not fields[1].isdigit():
+                    break
+                done.append(l)
+                offset = int(fields[1])
+    # the output was removed or cut behind the progress, start over
+    if not os.path.exists(fn) or os.path.getsize(fn) < offset:
+        done = []
+        offset = 0
+    status, catalog = get_json(board, 'catalog.json', offline, PRIORITY_BACKGROUND)
+    if status != 200:
+        print("Error %d" % status)
+        return None
+    exported = posts_count = failed = 0
+    with open(fn, 'ab' if done else 'wb') as out, open(progress_fn, 'wt') as progress:
+        # drop a thread left half-written by an interrupted run
+        out.truncate(offset)
+        progress.writelines(done)
+        progress.flush()
+        done = set(l.split()[0] for l in done)
+        for t in catalog["threads"]:
+            num = str(t["num"])
+            if num in done:
+                continue
+            status, data = get_json(board, 'res/%s.json' % num, offline, PRIORITY_BACKGROUND)
+            if status != 200:
+                failed += 1
+                continue
+            with compressed_writer(out, compression) as z:
+                for p in data["threads"][0]["posts"]:
+                    z.write((format_post_jsonl(p, board, text=True) + '\n').encode('utf-8'))
+                    posts_count += 1
+            out.flush()
+            progress.write('%s %d\n' % (num, out.tell()))
+            progress.flush()
+            exported += 1
+    if not failed:
+        os.remove(progress_fn)
+    return exported, posts_count, failed
+
+class Reader(object):
+    """
+    Curses thread reader. Only posts in view are converted, rendered lines
+    are kept in a small LRU cache and new posts arrive from a background
+    Watch.
+    """
+    def __init__(self, board, thread, offline=False):
+        self.board = board
+        self.thread = thread
+        self.offline = offline
+        self.posts = []
+        self.index = {}
+        self.rendered = OrderedDict()
+        self.top = 0
+        self.skip = 0
+        self.history = []
+        self.updates = Queue()
+        self.status = ''
+        self.quote_attr = self.file_attr = 0
+
+    def add_posts(self, posts):
+        for p in posts:
+            self.index[p["num"]] = len(self.posts)
+            self.posts.append(p)
+
+    def load(self):
+        """
+        Opens the thread from the mirror when it is there, from the site
+        otherwise
+        """
+        status, data = get_json(self.board, 'res/%s.json' % self.thread, offline=True)
+        if status != 200 and not self.offline:
+            status, data = get_json(self.board, 'res/%s.json' % self.thread)
+        if status == 200:
+            self.add_posts(data["threads"][0]["posts"])
+        return status
+
+    def follow(self, stop):
+        w = Watch(self.board, self.thread)
+        w.seen = self.posts[-1]["num"] if self.posts else None
+        while not stop.wait(w.interval):
+            new = w.poll()
+            if new:
+                self.updates.put(new)
+            if w.dead:
+                break
+            w.adapt(new)
+
+    def render(self, i, width):
+        """
+        :returns: Screen lines of the i-th post as (text, attribute)
+        :rtype: list
+        """
+        p = self.posts[i]
+        key = (p["num"], width)
+        lines = self.rendered.get(key)
+        if lines is not None:
+            self.rendered.move_to_end(key)
+            return lines
+        lines = [(plain_header(p), curses.A_BOLD)]
+        for f in p["files"]:
+            lines.append(("%s/%s/%s" % (BASE_URL, self.board, f["path"]), self.file_attr))
+        for l in html2text(p["comment"], plain=True, width=width - 1).rstrip('\n').split('\n'):
+            lines.append((l, self.quote_attr if l.startswith('>') else 0))
+        lines.append(("-" * (width - 1), curses.A_DIM))
+        self.rendered[key] = lines
+        if len(self.rendered) > READER_CACHE_SIZE:
+            self.rendered.popitem(last=False)
+        return lines
+
+    def scroll(self, n, width):
+        while n > 0:
+            left = len(self.render(self.top, width)) - self.skip - 1
+            if n <= left:
+                self.skip += n
+                n = 0
+            elif self.top + 1 < len(self.posts):
+                n -= left + 1
+                self.top += 1
+                self.skip = 0
+            else:
+                self.skip += left
+                break
+        while n < 0:
+            if -n <= self.skip:
+                self.skip += n
+                n = 0
+            elif self.top > 0:
+                n += self.skip + 1
+                self.top -= 1
+                self.skip = len(self.render(self.top, width)) - 1
+            else:
+                self.skip = 0
+                break
+
+    def jump(self, num):
+        if num not in self.index:
+            self.status = 'No >>%s in this thread' % num
+            return
+        self.history.append((self.top, self.skip))
+        self.top = self.index[num]
+        self.skip = 0
+
+    def follow_reference(self):
+        refs = RE_REPLY_LINK.findall(self.posts[self.top]["comment"])
+        for num in refs:
+            if int(num) in self.index:
+                self.jump(int(num))
+                return
+        self.status = 'No references to posts in this thread' if not refs else 'No >>%s in this thread' % refs[0]
+
+    def draw(self, scr):
+        height, width = scr.getmaxyx()
+        scr.erase()
+        y = 0
+        i = self.top
+        skip = self.skip
+        while y < height - 1 and i < len(self.posts):
+            for text, attr in self.render(i, width)[skip:]:
+                if y >= height - 1:
+                    break
+                scr.addnstr(y, 0, text, width - 1, attr)
+                y += 1
+            i += 1
+            skip = 0
+        bar = '/%s/res/%s  %d/%d  %s' % (self.board, self.thread, self.top + 1, len(self.posts), self.status)
+        scr.addnstr(height - 1, 0, bar.ljust(width - 1), width - 1, curses.A_REVERSE)
+        scr.refresh()
+
+    def prompt(self, scr, text):
+        height, width = scr.getmaxyx()
+        scr.addnstr(height - 1, 0, text.ljust(width - 1), width - 1, curses.A_REVERSE)
+        curses.echo()
+        try:
+            return scr.getstr(height - 1, len(text)).decode('utf-8')
+        finally:
+            curses.noecho()
+
+    def run(self, scr):
+        curses.curs_set(0)
+        if curses.has_colors():
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_GREEN, -1)
+            curses.init_pair(2, curses.COLOR_MAGENTA, -1)
+            self.quote_attr = curses.color_pair(1)
+            self.file_attr = curses.color_pair(2)
+        scr.timeout(READER_POLL_MS)
+        stop = threading.Event()
+        if not self.offline:
+            threading.Thread(target=self.follow, args=(stop,), daemon=True).start()
+        try:
+            self.draw(scr)
+            while True:
+                key = scr.getch()
+                height, width = scr.getmaxyx()
+                if key == -1:
+                    if self.updates.empty():
+                        continue
+                    added = 0
+                    while not self.updates.empty():
+                        new = self.updates.get()
+                        self.add_posts(new)
+                        added += len(new)
+                    self.status = '%d new' % added
+                elif key in (ord('q'), 27):
+                    break
+                else:
+                    self.status = ''
+                if key in (ord('j'), curses.KEY_DOWN, 10):
+                    self.scroll(1, width)
+                elif key in (ord('k'), curses.KEY_UP):
+                    self.scroll(-1, width)
+                elif key in (ord(' '), curses.KEY_NPAGE):
+                    self.scroll(height - 2, width)
+                elif key in (ord('b'), curses.KEY_PPAGE):
+                    self.scroll(-(height - 2), width)
+                elif key in (ord('n'), curses.KEY_RIGHT):
+                    self.top, self.skip = min(self.top + 1, len(self.posts) - 1), 0
+                elif key in (ord('p'), curses.KEY_LEFT):
+                    self.top, self.skip = max(self.top - (0 if self.skip else 1), 0), 0
+                elif key in (ord('g'), curses.KEY_HOME):
+                    self.top, self.skip = 0, 0
+                elif key in (ord('G'), curses.KEY_END):
+                    self.top, self.skip = len(self.posts) - 1, 0
+                elif key == ord('>'):
+                    self.follow_reference()
+                elif key == ord('<') and self.history:
+                    self.top, self.skip = self.history.pop()
+                elif key == ord('#'):
+                    num = self.prompt(scr, 'Go to post: ').strip().lstrip('>')
+                    if num.isdigit():
+                        self.jump(int(num))
+                self.skip = min(self.skip, len(self.render(self.top, width)) - 1)
+                self.draw(scr)
+        finally:
+            stop.set()
+
+def read(board, thread, offline=False):
+    if curses is None:
+        print("Interactive reader requires curses")
+        return False
+    reader = Reader(board, thread, offline)
+    status = reader.load()
+    if status != 200:
+        print("Error %d" % status)
+        return False
+    curses.wrapper(reader.run)
+    return True
+
+def optimize_image(data):
+    """
+    Strips metadata from JPEG and PNG images, recompresses them and
+    downsizes them to IMAGE_MAX_DIMENSION. EXIF orientation is applied to
+    the pixels before it is stripped. Other formats (GIF, WebM) and
+    images which do not get smaller are returned as is.
+
+    :rtype: bytes
+    """
+    try:
+        img = Image.open(BytesIO(data))
+        fmt = img.format
+        if fmt not in ('JPEG', 'PNG'):
+            return data
+        img.load()
+    except Exception:
+        return data
+    has_meta = any(k in img.info for k in ('exif', 'icc_profile', 'xmp', 'comment'))
+    img = ImageOps.exif_transpose(img)
+    # PNG saves whatever is left in info, ICC profile included
+    img.info = {}
+    resized = max(img.size) > IMAGE_MAX_DIMENSION
+    if resized:
+        img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    out = BytesIO()
+    if fmt == 'JPEG':
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        img.save(out, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        img.save(out, 'PNG', optimize=True)
+    res = out.getvalue()
+    if len(res) >= len(data) and not resized and not has_meta:
+        return data
+    return res
+
+def prepare_images(images):
+    """
+    Runs optimize_image over attachments in a process pool.
+
+    :returns: Processed images and number of bytes saved
+    :rtype: tuple
+    """
+    if not images:
+        return images, 0
+    if Image is None:
+        print("Image preprocessing requires Pillow, sending images as is")
+        return images, 0
+    if len(images) == 1:
+        res = [optimize_image(images[0])]
+    elif 'fork' in get_all_start_methods():
+        # The script parses arguments at import time, so workers are forked
+        # rather than spawned from a fresh interpreter.
+        with ProcessPoolExecutor(min(IMAGE_WORKERS, len(images)), mp_context=get_context('fork')) as pool:
+            res = list(pool.map(optimize_image, images))
+    else:
+        with ThreadPoolExecutor(min(IMAGE_WORKERS, len(images))) as pool:
+            res = list(pool.map(optimize_image, images))
+    return res, sum(map(len, images)) - sum(map(len, res))
+
+def optimize_attachments(images):
+    images, saved = prepare_images(images)
+    if images:
+        print("Images: %d bytes saved" % saved)
+    return images
+
+def thread_md5s(board, thread, offline=False):
+    """
+    :returns: md5 hashes of files already posted to the thread, taken from
+    a single fetch of the thread or from the mirror if that fails
+    :rtype: set
+    """
+    data = None
+    if not offline:
+        try:
+            _, data = get_json(board, 'res/%s.json' % thread)
+        except HTTPError:
+            pass
+    if data is None:
+        _, data = get_json(board, 'res/%s.json' % thread, offline=True)
+    if data is None:
+        return set()
+    return set(f['md5'] for p in data['threads'][0]['posts']
+               for f in p.get('files') or [] if f.get('md5'))
+
+def image_md5(data):
+    return md5(data).hexdigest()
+
+def check_duplicates(board, thread, images, drop=False, offline=False):
+    """
+    Warns about attachments which are already in the thread or repeated
+    in the post, dropping them if asked. The thread is fetched while the
+    attachments are being hashed.
+
+    :returns: Attachments to upload
+    :rtype: list
+    """
+    if not images:
+        return images
+    with ThreadPoolExecutor(min(len(images), HASH_WORKERS) + 1) as pool:
+        known = pool.submit(thread_md5s, board, thread, offline)
+        hashes = list(pool.map(image_md5, images))
+        known = known.result()
+    res = []
+    for i, (img, h) in enumerate(zip(images, hashes), 1):
+        if h in known:
+            print("Image %d is a duplicate (md5 %s)%s" % (i, h, ', dropped' if drop else ''))
+            if drop:
+                continue
+        known.add(h)
+        res.append(img)
+    return res
+
+def prepare_attachments(board, thread, comment, images, optimize=False, drop=False, offline=False):
+    """
+    Drops attachments already in the thread when asked (see
+    check_duplicates, the thread is only fetched then), then preprocesses
+    them when asked.
+
+    :returns: Attachments to upload, None when all of them were dropped
+    and there is no comment left to post
+    :rtype: list
+    """
+    if drop and images:
+        images = check_duplicates(board, thread, images, drop, offline)
+        if not images and not comment.strip():
+            print("Nothing left to post")
+            return None
+    if optimize:
+        images = optimize_attachments(images)
+    return images
+
+def post(board, thread, comment, captcha_id, captcha_value, subject=None, name=None, email=None, images=None):
+    query_fields = {'json': '1',
+                    'task': 'post',
+                    'captcha_type': '2chaptcha',
+                    'board': board,
+                    'thread': thread,
+                    '2chaptcha_id': captcha_id,
+                    '2chaptcha_value': captcha_value}
+    encoded_fields = urlencode(query_fields)
+    URL = '%s/makaba/posting.fcgi?%s' % (BASE_URL, encoded_fields)
+    fields = {'comment': comment}
+    if email:
+        fields['email'] = email
+    if name:
+        fields['name'] = name
+    if subject:
+        fields['subject'] = subject
+    if images:
+        for i in range(min(len(images),4)):
+            fields['image%d' % i] = ('yourmom%d.png' % i, images[i])
+    resp = request('POST', URL, fields=fields)
+    data = loads(resp.data.decode('utf-8'))
+    if ('Status' in data) and (data['Status'] == 'OK' or data['Status'] == 'Redirect'):
+        print('OK: %s' % data['Num'])
+        record_own(board, thread, data['Num'])
+        return True
+    else:
+        print('Error: %d %s' % (data['Error'], data['Reason']))
+        return False
+
+def finish_draft(header, comment, parsed=None):
+    """
+    :returns: Draft from header lines and comment lines (None when the
+    header was not closed with '...'), parsed is the header when already
+    parsed. Image files are checked, not read.
+    :rtype: dict
+    """
+    draft = {'comment': '', 'images': [], 'error': None}
+    if parsed is None:
+        try:
+            parsed = yaml.load(''.join(header), Loader=YAML_LOADER)
+        except yaml.YAMLError as e:
+            draft['error'] = 'bad header: %s' % e
+            return draft
+    if parsed is None:
+        parsed = {}
+    if not isinstance(parsed, dict):
+        draft['error'] = 'header is not a mapping'
+        return draft
+    draft.update(parsed)
+    for k in ('name', 'subject', 'email'):
+        draft.setdefault(k, None)
+    if comment is None:
+        draft['error'] = "header is not closed with '...'"
+        return draft
+    draft['comment'] = ''.join(comment)
+    for k in IMAGE_KEYS:
+        fn = draft.get(k)
+        if not fn:
+            continue
+        try:
+            size = os.stat(fn).st_size
+        except OSError as e:
+            draft['error'] = '%s: %s' % (k, e.strerror)
+            return draft
+        if size > IMAGE_MAX_SIZE:
+            draft['error'] = '%s: %d bytes, more than %d' % (k, size, IMAGE_MAX_SIZE)
+            return draft
+        draft['images'].append(fn)
+    return draft
+
+def draft_header(lines):
+    """
+    :returns: The lines parsed when they are a draft header, a non-empty
+    YAML mapping, None otherwise
+    :rtype: dict
+    """
+    try:
+        parsed = yaml.load(''.join(lines), Loader=YAML_LOADER)
+    except yaml.YAMLError:
+        return None
+    return parsed if isinstance(parsed, dict) and parsed else None
+
+def read_drafts(f):
+    """
+    Reads post drafts in a single pass. Every draft is a YAML header
+    (optionally opened with '---') closed by '...' and followed by the
+    comment, which runs until a '---' line followed by the header of the
+    next draft. Any other '---' line is a part of the comment.
+
+    :returns: Drafts with 'comment', image paths in 'images' and 'error'
+    set for drafts which can not be posted
+    :rtype: list
+    """
+    drafts = []
+    header = []
+    parsed = None
+    comment = None
+    pending = None
+    for l in f:
+        marker = l.rstrip('\r\n')
+        if pending is not None:
+            next_header = draft_header(pending[1:]) if marker == '...' else None
+            if next_header is not None:
+                drafts.append(finish_draft(header, comment, parsed))
+                header = pending[1:]
+                parsed = next_header
+                comment = []
+                pending = None
+            elif marker == '---':
+                comment.extend(pending)
+                pending = [l]
+            else:
+                pending.append(l)
+        elif comment is not None:
+            if marker == '---':
+                pending = [l]
+            else:
+                comment.append(l)
+        elif marker == '---' and not header:
+            continue
+        elif marker == '...':
+            comment = []
+        else:
+            header.append(l)
+    if pending is not None:
+        comment.extend(pending)
+    if header or comment is not None:
+        drafts.append(finish_draft(header, comment, parsed))
+    return drafts
+
+def load_images(draft):
+    imgs = []
+    for fn in draft['images']:
+        with open(fn, 'rb') as f:
+            imgs.append(f.read())
+    return imgs
 
 def parse_post(f):
-    parsed = yaml.load_all(f)
-    post_header = next(parsed)
+    drafts = read_drafts(f)
+    if not drafts:
+        return None
+    post_header = drafts[0]
+    if post_header['error']:
+        print(post_header['error'])
+        return None
     if 'postready' in post_header and (not post_header['postready']):
         print("Post not ready")
         return None
-    f.seek(0)
-    l = f.readline()
-    while (l != '...\n') and (l != ''):
-        l = f.readline()
-    if l == '':
-        return None
-    comment = f.read()
-    post_header['comment'] = comment
-    imgs = []
-    if 'image1' in post_header and post_header['image1']:
-        with open(post_header['image1'], 'rb') as f:
-            imgs += [f.read()]
-    if 'image2' in post_header and post_header['image2']:
-        with open(post_header['image2'], 'rb') as f:
-            imgs += [f.read()]
-    if 'image3' in post_header and post_header['image3']:
-        with open(post_header['image3'], 'rb') as f:
-            imgs += [f.read()]
-    if 'image4' in post_header and post_header['image4']:
-        with open(post_header['image4'], 'rb') as f:
-            imgs += [f.read()]
-    post_header['imgs'] = imgs
+    post_header['imgs'] = load_images(post_header)
     return post_header
 
 init(wrap=False)
 
-parser = ArgumentParser(add_help=True, description='Sosacheeque command-line client')
+parser = ArgumentParser(add_help=True, description='Sosacheeque command-line client',
+                        epilog='%(prog)s --daemon starts the background daemon, %(prog)s --completion {bash,zsh} prints a shell completion script')
 parser.add_argument('board', action='store', help='specify board')
+parser.add_argument('-u', '--url', action='store', help='site URL, %s by default' % BASE_URL)
+parser.add_argument('-M', '--mirror', action='append', default=[], metavar='URL', help='equivalent site to read from when faster or when the site fails (SOSUCH_MIRRORS, comma separated)')
+parser.add_argument('--hedge', action='store_true', help='repeat slow reads on a second mirror and take the first answer')
+parser.add_argument('-f', '--format', action='store', choices=OUTPUT_FORMATS, default='text', help='output format')
+parser.add_argument('-t', '--text', action='store_true', help='add converted comment text to jsonl records')
+parser.add_argument('-w', '--wrap', action='store_true', help='wrap posts at terminal width')
+parser.add_argument('--width', action='store', type=int, default=0, help='wrap posts at given width')
+parser.add_argument('-Q', '--quotes', action='store_true', help='show posts quoted from other threads')
+parser.add_argument('-P', '--no-pager', action='store_true', help='do not page terminal output')
+parser.add_argument('-O', '--optimize-images', action='store_true', help='strip metadata, recompress and downsize attached images')
+parser.add_argument('--solver', action='store', metavar='COMMAND', help='long-running captcha solver (SOSUCH_SOLVER), %s is run per captcha otherwise' % CAPTCHA_RESOLVE_SCRIPT)
+parser.add_argument('--solvers', action='store', type=int, default=CAPTCHA_SOLVERS, metavar='N', help='number of solvers to start')
+parser.add_argument('-D', '--drop-duplicates', action='store_true', help='do not upload images already posted to the thread')
+parser.add_argument('--offline', action='store_true', help='read threads from the local mirror')
+parser.add_argument('-r', '--rate', action='append', default=[], metavar='[HOST=]RATE[:BURST]', help='requests per second to a host (all hosts by default), 0 for unlimited; %s by default' % ('%g:%d' % RATE_LIMITS['*']))
+parser.add_argument('--metrics', action='store', metavar='PORT|FILE', help='export Prometheus metrics on a local port or to a file')
+parser.add_argument('-l', '--lite', action='store_true', help='list threads from the small threads index, one line each')
+parser.add_argument('--no-daemon', action='store_true', help='do not forward the command to a running daemon (start one with --daemon)')
 board_parsers = parser.add_subparsers(help='board commands', dest='board_action')
 thread_parser = board_parsers.add_parser('thread', help='list posts in thread')
 thread_parser.add_argument('thread_num', action='store', help='specify thread')
@@ -1352,53 +4162,368 @@ file_thread_parser = thread_actions.add_parser('file', help='post from file')
 file_thread_parser.add_argument('file_name', action='store', type=FileType('rt'), help='file name with post content')
 editor_thread_parser = thread_actions.add_parser('editor', help='post using external editor')
 editor_thread_parser.add_argument('-q', '--quote', action='store', help='answer to', default=None)
-                   
-args = parser.parse_args()
-
-if args.board_action == 'thread':
-    if args.thread_action == 'file':
-        p = parse_post(args.file_name)
-        if p:
+read_thread_parser = thread_actions.add_parser('read', help='read thread interactively')
+watch_parser = board_parsers.add_parser('watch', help='follow threads and print new posts')
+watch_parser.add_argument('watch_specs', action='store', nargs='+', metavar='thread', help='thread number, board/number, catalog or board/catalog')
+watch_parser.add_argument('--min-interval', action='store', type=float, default=WATCH_MIN_INTERVAL, help='shortest poll interval in seconds')
+watch_parser.add_argument('--max-interval', action='store', type=float, default=WATCH_MAX_INTERVAL, help='longest poll interval in seconds')
+replies_parser = board_parsers.add_parser('replies', help='show new replies to your posts')
+replies_parser.add_argument('--follow', action='store_true', help='keep watching threads with your posts')
+replies_parser.add_argument('--min-interval', action='store', type=float, default=WATCH_MIN_INTERVAL, help='shortest poll interval in seconds')
+replies_parser.add_argument('--max-interval', action='store', type=float, default=WATCH_MAX_INTERVAL, help='longest poll interval in seconds')
+sync_parser = board_parsers.add_parser('sync', help='update local mirror of the board')
+grep_parser = board_parsers.add_parser('grep', help='search comments in all threads of the board')
+grep_parser.add_argument('pattern', action='store', help='regular expression')
+grep_parser.add_argument('-i', '--ignore-case', action='store_true', help='ignore case')
+grep_parser.add_argument('-F', '--fixed-strings', action='store_true', help='pattern is a plain string')
+grep_parser.add_argument('-m', '--max-matches', action='store', type=int, default=0, help='stop after this many matches')
+archive_parser = board_parsers.add_parser('archive', help='render mirrored threads into static pages')
+archive_parser.add_argument('archive_dir', action='store', help='output directory, updated incrementally')
+archive_parser.add_argument('archive_threads', action='store', nargs='*', metavar='thread', help='threads to archive, all mirrored threads by default')
+archive_parser.add_argument('-m', '--markdown', action='store_true', help='write Markdown instead of HTML')
+archive_parser.add_argument('--media', action='store_true', help='download attached files and link them locally')
+diff_parser = board_parsers.add_parser('diff', help='show posts deleted, edited or added since the previous diff')
+diff_parser.add_argument('diff_threads', action='store', nargs='*', metavar='thread', help='threads to compare, all threads in the catalog by default')
+stats_parser = board_parsers.add_parser('stats', help='posting statistics of the local mirror')
+export_parser = board_parsers.add_parser('export', help='export all threads to compressed jsonl')
+export_parser.add_argument('export_file', action='store', help='output file, resumed if FILE.progress exists')
+export_parser.add_argument('-z', '--compression', action='store', choices=['gzip', 'zstd'], help='gzip by default, zstd for .zst files')
+
+def main(argv=None):
+    global BASE_URL, MIRRORS, HEDGE, CAPTCHA_SOLVER, CAPTCHA_SOLVERS, PAGER, BODY_WIDTH, WATCH_MIN_INTERVAL, WATCH_MAX_INTERVAL, RATE_LIMITS
+    args = parser.parse_args(argv)
+
+    if args.mirror:
+        MIRRORS = MIRRORS + [m.rstrip('/') for m in args.mirror]
+    HEDGE = args.hedge
+    if args.solver:
+        CAPTCHA_SOLVER = args.solver
+    CAPTCHA_SOLVERS = max(1, args.solvers)
+
+    if args.metrics:
+        start_metrics(args.metrics)
+    if args.rate:
+        RATE_LIMITS = dict(RATE_LIMITS)
+        try:
+            RATE_LIMITS.update(parse_rate(r) for r in args.rate)
+        except ValueError:
+            parser.error('bad --rate value')
+
+    if args.url:
+        BASE_URL = args.url.rstrip('/')
+
+    if args.no_pager:
+        PAGER = ''
+    if args.width:
+        BODY_WIDTH = args.width
+    elif args.wrap:
+        BODY_WIDTH = terminal_width()
+
+    if args.board_action == 'thread':
+        if args.thread_action == 'file':
+            drafts = read_drafts(args.file_name)
+            if not drafts:
+                print("Error parsing post file")
+                sys.exit(1)
+            failed = 0
+            for i, p in enumerate(drafts, 1):
+                if p['error']:
+                    print("Draft %d: %s" % (i, p['error']))
+                    failed += 1
+                    continue
+                if 'postready' in p and (not p['postready']):
+                    print("Draft %d: post not ready" % i)
+                    continue
+                imgs = prepare_attachments(args.board, args.thread_num, p['comment'], load_images(p),
+                                           args.optimize_images, args.drop_duplicates, args.offline)
+                if imgs is None:
+                    failed += 1
+                    continue
+                (captcha_value, captcha_id) = resolve_captcha()
+                if not post(args.board, args.thread_num, p['comment'], captcha_id, captcha_value, subject=p['subject'], name=p['name'], email=p['email'], images=imgs):
+                    failed += 1
+            sys.exit(1 if failed else 0)
+        elif args.thread_action == 'editor':
+            _, fn = mkstemp(prefix='sosuch')
+            with open(fn, 'wt') as f:
+                f.write(POST_TEMPLATE)
+                if args.quote:
+                    f.write('>>' + args.quote + '\n')
+            res = call([EDITOR, fn]) 
+            if res == 0:
+                with open(fn, 'rt') as f:
+                    p = parse_post(f)
+                    if p:
+                        if p['comment'].strip() == '' and p['imgs'] == []:
+                            print('Post is empty, draft saved to %s' % fn)
+                            sys.exit(1)
+                        p['imgs'] = prepare_attachments(args.board, args.thread_num, p['comment'], p['imgs'],
+                                                        args.optimize_images, args.drop_duplicates, args.offline)
+                        if p['imgs'] is None:
+                            print('Draft saved to %s' % fn)
+                            sys.exit(1)
+                        (captcha_value, captcha_id) = resolve_captcha()
+                        res = post(args.board, args.thread_num, p['comment'], captcha_id, captcha_value, subject=p['subject'], name=p['name'], email=p['email'], images=p['imgs'])
+                        if res:
+                            os.remove(fn)
+                        else:
+                            print('Error posting file, draft saved to %s' % fn)
+                            sys.exit(1)
+                    else:
+                        print('Error parsing post file, draft saved to %s' % fn)
+                        sys.exit(1)
+            else:
+                print('Aborting post, draft saved to %s' % fn)
+                sys.exit(res)
+        elif args.thread_action == 'read':
+            sys.exit(0 if read(args.board, args.thread_num, args.offline) else 1)
+        elif args.thread_action == 'post':
+            imgs = [i.read() for i in args.image] if args.image else []
+            imgs = prepare_attachments(args.board, args.thread_num, args.comment, imgs,
+                                       args.optimize_images, args.drop_duplicates, args.offline)
+            if imgs is None:
+                sys.exit(1)
             (captcha_value, captcha_id) = resolve_captcha()
-            res = post(args.board, args.thread_num, p['comment'], captcha_id, captcha_value, subject=p['subject'], name=p['name'], email=p['email'], images=p['imgs'])
+            comment = args.comment
+            if args.quote:
+                comment = '>>%s\n' % args.quote + comment
+            res = post(args.board, args.thread_num, comment, captcha_id, captcha_value, subject=args.subject, name=args.name, email=args.email, images=imgs)
             sys.exit(0) if res else sys.exit(1)
         else:
-            print("Error parsing post file")
+            posts(args.board, args.thread_num, args.format, args.text, args.offline, args.quotes)
+    elif args.board_action == 'sync':
+        summary = sync(args.board)
+        if summary is None:
             sys.exit(1)
-    elif args.thread_action == 'editor':
-        _, fn = mkstemp(prefix='sosuch')
-        with open(fn, 'wt') as f:
-            f.write(POST_TEMPLATE)
-            if args.quote:
-                f.write('>>' + args.quote + '\n')
-        res = call([EDITOR, fn]) 
-        if res == 0:
-            with open(fn, 'rt') as f:
-                p = parse_post(f)
-                if p:
-                    if p['comment'].strip() == '' and p['imgs'] == []:
-                        print('Post is empty, draft saved to %s' % fn)
-                        sys.exit(1)
-                    (captcha_value, captcha_id) = resolve_captcha()
-                    res = post(args.board, args.thread_num, p['comment'], captcha_id, captcha_value, subject=p['subject'], name=p['name'], email=p['email'], images=p['imgs'])
-                    if res:
-                        os.remove(fn)
-                    else:
-                        print('Error posting file, draft saved to %s' % fn)
-                        sys.exit(1)
-                else:
-                    print('Error parsing post file, draft saved to %s' % fn)
-                    sys.exit(1)
-        else:
-            print('Aborting post, draft saved to %s' % fn)
-            sys.exit(res)
-    elif args.thread_action == 'post':
-        imgs = [i.read() for i in args.image] if args.image else None
-        (captcha_value, captcha_id) = resolve_captcha()
-        comment += '>>' + args.quote + '\n' + args.comment
-        res = post(args.board, args.thread_num, comment, captcha_id, captcha_value, subject=args.subject, name=args.name, email=args.email, images=imgs)
-        sys.exit(0) if res else sys.exit(1)
+        print("/%s/: %d threads, %d fetched, %d unchanged, %d archived, %d failed, %d bytes in %.1fs" %
+              (args.board, summary['threads'], summary['fetched'], summary['unchanged'], summary['archived'],
+               summary['failed'], summary['bytes'], summary['seconds']))
+    elif args.board_action == 'grep':
+        pattern = re.escape(args.pattern) if args.fixed_strings else args.pattern
+        try:
+            pattern = re.compile(pattern, re.IGNORECASE if args.ignore_case else 0)
+        except re.error as e:
+            parser.error('bad pattern: %s' % e)
+        try:
+            sys.exit(0 if grep(args.board, pattern, args.format, args.offline, args.max_matches) else 1)
+        except KeyboardInterrupt:
+            sys.exit(130)
+    elif args.board_action == 'archive':
+        res = archive(args.board, args.archive_dir, 'markdown' if args.markdown else 'html', args.archive_threads, args.media)
+        print("%d threads, %d rendered (%d posts), %d unchanged, %d pages written, %d files downloaded, %d missing" %
+              (res['threads'], res['rendered'], res['posts'], res['unchanged'], res['written'], res['media'], res['missing']))
+        sys.exit(1 if res['missing'] else 0)
+    elif args.board_action == 'diff':
+        res = diff(args.board, args.diff_threads, args.format, args.text, args.offline)
+        if res is None:
+            sys.exit(1)
+        if args.format != 'jsonl':
+            print("%d threads, %d deleted, %d edited, %d new posts, %d first recorded, %d gone, %d failed" %
+                  (res['threads'], res['deleted'], res['edited'], res['new'], res['recorded'], res['gone'], res['failed']))
+        sys.exit(1 if res['deleted'] or res['edited'] else 0)
+    elif args.board_action == 'stats':
+        sys.exit(0 if stats(args.board, args.format) else 1)
+    elif args.board_action == 'export':
+        compression = args.compression or ('zstd' if args.export_file.endswith('.zst') else 'gzip')
+        res = export(args.board, args.export_file, compression, args.offline)
+        if res is None:
+            sys.exit(1)
+        print("%d threads, %d posts exported to %s, %d threads failed" % (res[0], res[1], args.export_file, res[2]))
+        sys.exit(1 if res[2] else 0)
+    elif args.board_action == 'replies':
+        WATCH_MIN_INTERVAL = args.min_interval
+        WATCH_MAX_INTERVAL = args.max_interval
+        try:
+            replies(args.board, args.format, args.text, args.follow)
+        except KeyboardInterrupt:
+            pass
+    elif args.board_action == 'watch':
+        WATCH_MIN_INTERVAL = args.min_interval
+        WATCH_MAX_INTERVAL = args.max_interval
+        try:
+            watch(args.board, args.watch_specs, args.format, args.text)
+        except KeyboardInterrupt:
+            pass
+    elif args.lite:
+        threads_lite(args.board, args.format, args.offline)
     else:
-        posts(args.board, args.thread_num)
-else:
-    threads(args.board)
+        threads(args.board, args.format, args.text, args.offline, args.quotes)
+
+class DaemonOutput(object):
+    """
+    stdout or stderr of a command run by the daemon, sent to the client in
+    frames of the given kind
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, sock, kind, tty=False):
+        self.sock = sock
+        self.kind = kind
+        self.tty = tty
+        self.buf = []
+        self.size = 0
+
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= DAEMON_FRAME_SIZE:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if not self.buf:
+            return
+        data = ''.join(self.buf).encode('utf-8')
+        self.buf = []
+        self.size = 0
+        try:
+            send_frame(self.sock, self.kind, data)
+        except OSError:
+            raise BrokenPipeError()
+
+    def isatty(self):
+        return self.tty
+
+    def page(self, pager):
+        self.flush()
+        send_frame(self.sock, b'p', pager.encode('utf-8'))
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one forwarded command, or solves a captcha for a posting command,
+    in the daemon. Connections are served in threads but commands run one
+    at a time: they share module configuration, stdout and working
+    directory. A command starts only once its client confirms it is still
+    waiting (see forward).
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # liveness probe from serve()
+            return
+        request = loads(line.decode('utf-8'))
+        if 'solve' in request:
+            self.solve(request)
+            return
+        if any(os.environ.get(k) != v for k, v in request['env'].items()):
+            # started for another site or mirror, let the client run it
+            send_frame(self.connection, b'r', b'')
+            return
+        with self.server.command_lock:
+            try:
+                send_frame(self.connection, b's', b'')
+                self.connection.settimeout(DAEMON_WAIT * 4)
+                go = self.rfile.read(1)
+                self.connection.settimeout(None)
+            except OSError:
+                return
+            if go != b'g':
+                # client gave up waiting and runs the command itself
+                return
+            self.run(request)
+
+    def run(self, request):
+        out = DaemonOutput(self.connection, b'o', request['tty'])
+        err = DaemonOutput(self.connection, b'e')
+        saved = dict((k, globals()[k]) for k in DAEMON_GLOBALS)
+        cwd = os.getcwd()
+        columns = os.environ.get('COLUMNS')
+        os.chdir(request['cwd'])
+        os.environ['COLUMNS'] = str(request['columns'])
+        sys.stdout, sys.stderr = out, err
+        globals()['PAGER'] = request['pager']
+        try:
+            code = main(request['argv']) or 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BrokenPipeError:
+            code = 0
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+            globals().update(saved)
+            os.chdir(cwd)
+            if columns is None:
+                del os.environ['COLUMNS']
+            else:
+                os.environ['COLUMNS'] = columns
+        try:
+            out.flush()
+            err.flush()
+            send_frame(self.connection, b'x', str(code).encode('utf-8'))
+        except OSError:
+            pass
+
+    def solve(self, request):
+        """
+        Solves a captcha sent by daemon_solve() with the daemon's solvers
+        """
+        img = self.rfile.read(request['size'])
+        try:
+            solution = solver_pool(request['solver'], request['solvers'], request['cwd']).solve(request['solve'], img)
+        except OSError:
+            solution = None
+        try:
+            send_frame(self.connection, b'c', (solution or '').encode('utf-8'))
+        except OSError:
+            pass
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        socketserver.UnixStreamServer.__init__(self, *args)
+        self.command_lock = threading.Lock()
+
+def serve(path=DAEMON_SOCKET):
+    """
+    Serves commands forwarded by the CLI on a Unix socket, keeping the
+    connection pool and caches warm between them.
+
+    :rtype: int
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print("Daemon is already running on %s" % path)
+            return 1
+        except OSError:
+            os.unlink(path)
+        finally:
+            probe.close()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    server = DaemonServer(path, DaemonHandler)
+    os.chmod(path, 0o600)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Listening on %s" % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+    return 0
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--daemon']:
+        daemon_parser = ArgumentParser(prog=parser.prog + ' --daemon', description='Serve commands forwarded by the CLI')
+        daemon_parser.add_argument('--metrics', action='store', metavar='PORT|FILE', help='export Prometheus metrics on a local port or to a file')
+        daemon_args = daemon_parser.parse_args(sys.argv[2:])
+        if daemon_args.metrics:
+            start_metrics(daemon_args.metrics)
+        sys.exit(serve())
+    if sys.argv[1:2] == ['--completion']:
+        if len(sys.argv) != 3 or sys.argv[2] not in COMPLETE_SCRIPTS:
+            print("usage: %s --completion {%s}" % (parser.prog, ','.join(sorted(COMPLETE_SCRIPTS))), file=sys.stderr)
+            sys.exit(2)
+        print(completion_script(sys.argv[2], parser.prog), end='')
+        sys.exit(0)
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import os
+import sys
+from json import dumps
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sosuch
+
+
+def link(thread, num):
+    return '<a href="/b/res/%d.html#%d" class="post-reply-link">&gt;&gt;%d</a>' % (thread, num, num)
+
+
+def write_thread(mirror, num, comments, subject='Thread'):
+    posts = [{'num': num + i, 'subject': subject if i == 0 else '', 'name': 'Anon',
+              'date': '01/01/24 00:00:00', 'comment': c, 'files': []}
+             for i, c in enumerate(comments)]
+    path = mirror / 'b' / 'res'
+    path.mkdir(parents=True, exist_ok=True)
+    (path / ('%d.json' % num)).write_text(dumps({'threads': [{'posts': posts}]}))
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    mirror = tmp_path / 'mirror'
+    monkeypatch.setattr(sosuch, 'MIRROR_DIR', str(mirror))
+    write_thread(mirror, 100, ['op', 'see ' + link(200, 201)])
+    write_thread(mirror, 200, ['op', 'back to ' + link(100, 100)])
+    write_thread(mirror, 300, ['op', 'quiet'])
+    return mirror
+
+
+def read(path):
+    with open(str(path)) as f:
+        return f.read()
+
+
+def test_full_build(mirror, tmp_path):
+    out = tmp_path / 'out'
+    stats = sosuch.archive('b', str(out))
+    assert stats['rendered'] == 3
+    assert 'href="200.html#201"' in read(out / '100.html')
+    index = read(out / 'index.html')
+    assert all('href="%d.html"' % n in index for n in (100, 200, 300))
+
+
+def test_partial_build_links_only_existing_pages(mirror, tmp_path):
+    out = tmp_path / 'out'
+    sosuch.archive('b', str(out), nums=['200'])
+    assert not (out / '100.html').exists()
+    assert 'href="%s/b/res/100.html#100"' % sosuch.BASE_URL in read(out / '200.html')
+    # once 100 gets a page, 200 links to it
+    sosuch.archive('b', str(out), nums=['100'])
+    assert 'href="100.html#100"' in read(out / '200.html')
+
+
+def test_partial_rebuild_keeps_index_and_links(mirror, tmp_path):
+    out = tmp_path / 'out'
+    sosuch.archive('b', str(out))
+    write_thread(mirror, 100, ['op', 'see ' + link(200, 201), 'new post'])
+    stats = sosuch.archive('b', str(out), nums=['100'])
+    assert stats['rendered'] == 1
+    assert 'href="200.html#201"' in read(out / '100.html')
+    index = read(out / 'index.html')
+    assert all('href="%d.html"' % n in index for n in (100, 200, 300))
+
+
+def test_unchanged_rebuild(mirror, tmp_path):
+    out = tmp_path / 'out'
+    sosuch.archive('b', str(out))
+    mtimes = dict((n, os.stat(str(out / ('%d.html' % n))).st_mtime_ns) for n in (100, 200, 300))
+    stats = sosuch.archive('b', str(out))
+    assert stats['unchanged'] == 3 and stats['rendered'] == 0 and stats['written'] == 0
+    # a new thread is not linked from anywhere, nothing else is read again
+    write_thread(mirror, 400, ['op'])
+    stats = sosuch.archive('b', str(out))
+    assert stats['rendered'] == 1 and stats['unchanged'] == 3
+    assert mtimes == dict((n, os.stat(str(out / ('%d.html' % n))).st_mtime_ns) for n in (100, 200, 300))
+
+
+def test_title_escaped(mirror, tmp_path):
+    write_thread(mirror, 100, ['op'], subject='&lt;/title&gt;&lt;script&gt;alert(1)&lt;/script&gt;')
+    out = tmp_path / 'out'
+    sosuch.archive('b', str(out), nums=['100'])
+    page = read(out / '100.html')
+    assert '<script>' not in page
+    assert '<title>&lt;/title&gt;&lt;script&gt;' in page
@@ -0,0 +1,31 @@
+import os
+import sys
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sosuch import read_drafts, parse_post
+
+
+def test_rule_inside_comment():
+    post = parse_post(StringIO('subject: hi\n...\nline one\n---\nline after rule\n'))
+    assert post['subject'] == 'hi'
+    assert post['comment'] == 'line one\n---\nline after rule\n'
+
+
+def test_rule_inside_comment_single_draft():
+    drafts = read_drafts(StringIO('subject: hi\n...\nline one\n---\nline after rule\n...\nend\n'))
+    assert len(drafts) == 1
+    assert drafts[0]['error'] is None
+    assert drafts[0]['comment'] == 'line one\n---\nline after rule\n...\nend\n'
+
+
+def test_several_drafts():
+    drafts = read_drafts(StringIO('---\nname: a\n...\none\n---\nname: b\n...\ntwo\n---\n'))
+    assert [(d['name'], d['comment'], d['error']) for d in drafts] == [('a', 'one\n', None), ('b', 'two\n---\n', None)]
+
+
+def test_empty_header_inside_comment():
+    drafts = read_drafts(StringIO('subject: hi\n...\none\n---\n...\ntwo\n---\n\n...\nthree\n'))
+    assert len(drafts) == 1
+    assert drafts[0]['comment'] == 'one\n---\n...\ntwo\n---\n\n...\nthree\n'
@@ -0,0 +1,66 @@
+import gzip
+import os
+import sys
+from json import dumps, loads
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sosuch
+
+
+NUMS = (100, 200, 300)
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    mirror = tmp_path / 'mirror'
+    monkeypatch.setattr(sosuch, 'MIRROR_DIR', str(mirror))
+    (mirror / 'b' / 'res').mkdir(parents=True)
+    (mirror / 'b' / 'catalog.json').write_text(dumps({'threads': [{'num': n} for n in NUMS]}))
+    for n in NUMS:
+        posts = [{'num': n, 'comment': 'op', 'name': 'Anon', 'date': '', 'files': []}]
+        (mirror / 'b' / 'res' / ('%d.json' % n)).write_text(dumps({'threads': [{'posts': posts}]}))
+    return mirror
+
+
+def exported(fn):
+    with gzip.open(fn, 'rt') as f:
+        return [loads(l)['num'] for l in f]
+
+
+def test_resume(mirror, tmp_path):
+    fn = str(tmp_path / 'b.jsonl.gz')
+    catalog = mirror / 'b' / 'catalog.json'
+    full = catalog.read_text()
+    catalog.write_text(dumps({'threads': [{'num': 100}]}))
+    assert sosuch.export('b', fn, offline=True) == (1, 1, 0)
+    offset = os.path.getsize(fn)
+    # interrupted halfway through the second thread and its progress line
+    with open(fn, 'ab') as f:
+        f.write(gzip.compress(b'{"num": 200')[:15])
+    with open(fn + '.progress', 'wt') as f:
+        f.write('100 %d\n200 ' % offset)
+    catalog.write_text(full)
+    assert sosuch.export('b', fn, offline=True) == (2, 2, 0)
+    assert exported(fn) == list(NUMS)
+
+
+def test_missing_output_restarts(mirror, tmp_path):
+    fn = str(tmp_path / 'b.jsonl.gz')
+    with open(fn + '.progress', 'wt') as f:
+        f.write('100 1000\n200 2000\n')
+    assert sosuch.export('b', fn, offline=True) == (3, 3, 0)
+    assert sorted(exported(fn)) == list(NUMS)
+    assert not os.path.exists(fn + '.progress')
+
+
+def test_short_output_restarts(mirror, tmp_path):
+    fn = str(tmp_path / 'b.jsonl.gz')
+    with open(fn, 'wb') as f:
+        f.write(b'\0' * 10)
+    with open(fn + '.progress', 'wt') as f:
+        f.write('100 1000\n')
+    assert sosuch.export('b', fn, offline=True) == (3, 3, 0)
+    assert sorted(exported(fn)) == list(NUMS)
@@ -0,0 +1,37 @@
+import glob
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sosuch
+
+# posts and their text as converted before the tag dispatch tables and the
+# style cache, any change to the output shows up here
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'html2text')
+CORPUS = sorted(os.path.basename(fn)[:-5] for fn in glob.glob(os.path.join(FIXTURES, '*.html')))
+
+
+def fixture(name, ext):
+    with open(os.path.join(FIXTURES, name + ext), 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+@pytest.mark.parametrize('plain', [False, True])
+@pytest.mark.parametrize('name', CORPUS)
+def test_corpus(name, plain):
+    expected = fixture(name, '.plain.txt' if plain else '.txt')
+    assert sosuch.html2text(fixture(name, '.html'), plain=plain, width=0) == expected
+
+
+def test_style_cache(monkeypatch):
+    # the same output with a cold cache, a warm one and one cleared when full
+    monkeypatch.setattr(sosuch, 'STYLE_CACHE', {})
+    cold = [sosuch.html2text(fixture(name, '.html'), width=0) for name in CORPUS]
+    warm = [sosuch.html2text(fixture(name, '.html'), width=0) for name in CORPUS]
+    monkeypatch.setattr(sosuch, 'STYLE_CACHE_SIZE', 2)
+    monkeypatch.setattr(sosuch, 'STYLE_CACHE', {})
+    small = [sosuch.html2text(fixture(name, '.html'), width=0) for name in CORPUS]
+    assert cold == warm == small == [fixture(name, '.txt') for name in CORPUS]
@@ -0,0 +1,106 @@
+import os
+import socket
+import sys
+import threading
+import time
+from argparse import Namespace
+from json import dumps
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sosuch
+import makaba_standin
+
+
+def recording(path, nums):
+    (path / 'b' / 'res').mkdir(parents=True)
+    (path / 'b' / 'catalog.json').write_text(dumps({'threads': [{'num': n} for n in nums]}))
+    for n in nums:
+        posts = [{'num': n, 'comment': 'op', 'files': []}]
+        (path / 'b' / 'res' / ('%d.json' % n)).write_text(dumps({'threads': [{'posts': posts}]}))
+    return str(path)
+
+
+@pytest.fixture
+def standin(tmp_path):
+    servers = []
+
+    def start(nums=(100,), latency=0):
+        data = recording(tmp_path / str(len(servers)), nums)
+        server = makaba_standin.make_server(Namespace(port=0, data=data, latency=latency, jitter=0, bandwidth=0,
+                                                      error_rate=0, error_status=503, verbose=False))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:%d' % server.server_address[1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def site(monkeypatch):
+    def configure(base, *mirrors, hedge=False):
+        monkeypatch.setattr(sosuch, 'BASE_URL', base)
+        monkeypatch.setattr(sosuch, 'MIRRORS', list(mirrors))
+        monkeypatch.setattr(sosuch, 'HEDGE', hedge)
+    monkeypatch.setattr(sosuch, 'RATE_LIMITS', {'*': (0, 1)})
+    monkeypatch.setattr(sosuch, 'MIRROR_READ_TIMEOUT', 0.5)
+    monkeypatch.setattr(sosuch, 'HEDGE_DEFAULT_DELAY', 0.2)
+    monkeypatch.setattr(sosuch, 'mirror_stats', {})
+    return configure
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d' % port
+
+
+def timed(url):
+    started = time.time()
+    resp = sosuch.request('GET', url)
+    return resp.status, time.time() - started
+
+
+def test_failover_on_connection_error(standin, site):
+    base = closed_port()
+    site(base, standin())
+    status, _ = timed(base + '/b/res/100.json')
+    assert status == 200
+    assert sosuch.mirror_down(base)
+
+
+def test_failover_on_stall(standin, site):
+    base = standin(latency=5)
+    site(base, standin())
+    status, took = timed(base + '/b/res/100.json')
+    assert status == 200 and took < 2
+    assert sosuch.mirror_order()[0] != base
+
+
+def test_lagging_mirror_not_trusted(standin, site):
+    base = standin(nums=(100, 200))
+    mirror = standin(nums=(100,))
+    site(base, mirror)
+    sosuch.mirror_report(mirror + '/', 0.001)
+    sosuch.mirror_report(base + '/', 0.1)
+    status, _ = timed(base + '/b/res/200.json')
+    assert status == 200
+    assert sosuch.mirror_down(mirror)
+    # a thread missing everywhere is still 404
+    assert timed(base + '/b/res/300.json')[0] == 404
+
+
+def test_hedged_read(standin, site):
+    base = standin(latency=0.4)
+    down = closed_port()
+    site(base, down, standin(), hedge=True)
+    sosuch.mirror_report(down + '/', None)
+    status, took = timed(base + '/b/res/100.json')
+    assert status == 200 and took < 0.35
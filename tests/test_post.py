@@ -0,0 +1,58 @@
+import os
+import sys
+from io import BytesIO
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sosuch
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def posted(monkeypatch):
+    calls = []
+    monkeypatch.setattr(sosuch, 'resolve_captcha', lambda: ('solution', 'id'))
+    monkeypatch.setattr(sosuch, 'thread_md5s', lambda board, thread, offline=False: calls.append('md5s') or set())
+    monkeypatch.setattr(sosuch, 'post', lambda *args, **kwargs: calls.append((args, kwargs)) or True)
+    return calls
+
+
+def run(argv):
+    with pytest.raises(SystemExit) as e:
+        sosuch.main(argv)
+    return e.value.code
+
+
+def test_post_comment(posted):
+    assert run(['b', 'thread', '100', 'post', '-c', 'hello']) == 0
+    args, kwargs = posted[0]
+    assert args[:3] == ('b', '100', 'hello')
+    assert kwargs['images'] == []
+    assert 'md5s' not in posted
+
+
+def test_post_quote(posted):
+    assert run(['b', 'thread', '100', 'post', '-c', 'hello', '-q', '101']) == 0
+    assert posted[0][0][2] == '>>101\nhello'
+
+
+def test_post_optimized_image(posted, tmp_path):
+    fn = tmp_path / 'image.png'
+    Image.new('RGB', (64, 64), 'red').save(str(fn), icc_profile=b'\0' * 128)
+    assert run(['-O', 'b', 'thread', '100', 'post', '-c', 'hello', '-i', str(fn)]) == 0
+    img = Image.open(BytesIO(posted[0][1]['images'][0]))
+    assert img.size == (64, 64)
+    assert 'icc_profile' not in img.info
+
+
+def test_post_drop_duplicates(posted, tmp_path):
+    fn = tmp_path / 'image.png'
+    Image.new('RGB', (8, 8), 'red').save(str(fn))
+    assert run(['b', 'thread', '100', 'post', '-c', 'hello', '-i', str(fn)]) == 0
+    assert posted[0] != 'md5s'
+    assert run(['-D', 'b', 'thread', '100', 'post', '-c', 'hello', '-i', str(fn), '-i', str(fn)]) == 0
+    assert posted[1] == 'md5s'
+    assert len(posted[2][1]['images']) == 1
@@ -0,0 +1,40 @@
+import os
+import sys
+from json import dumps
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sosuch
+
+
+class Reply(object):
+    def __init__(self, data, status=200):
+        self.status = status
+        self.data = data.encode('utf-8')
+        self.headers = {'ETag': data}
+
+
+def thread(*nums):
+    return dumps({'threads': [{'posts': [{'num': n, 'timestamp': n, 'closed': 0} for n in nums]}]})
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    replies = []
+    monkeypatch.setattr(sosuch, 'request', lambda method, url, priority, **kwargs: replies.pop(0))
+    return replies
+
+
+@pytest.mark.parametrize('bad', ['{"threads": []}', '{"threads": [{"posts": []}]}', '{}', '[]', 'null', '{"threads'])
+def test_malformed_reply_backs_off(replies, bad):
+    w = sosuch.Watch('b', '100')
+    replies.extend([Reply(thread(100, 101)), Reply(bad), Reply(thread(100, 101, 102))])
+    assert w.poll() == []
+    interval = w.interval
+    assert w.poll() == []
+    assert not w.dead and w.headers['If-None-Match'] == thread(100, 101)
+    w.adapt([])
+    assert w.interval > interval
+    assert [p['num'] for p in w.poll()] == [102]